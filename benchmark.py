@@ -0,0 +1,368 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import folium
+import numpy as np
+import pandas as pd
+
+from carte_complete import (DATAFRAME_BUILDERS, DATASET_SCHEMAS, DATASETS, MAX_RECORDS_OFFSET, PAGE_SIZE, RENDER_MODES,
+                            create_combined_map, dataset_id, fetch_all_datasets, load_all_dataframes, save_map)
+from instrumentation import reset_metrics
+
+# Réponses enregistrées de l'API (une par jeu de données), rejouées par le serveur local
+PAYLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'payloads')
+DEFAULT_SCALES = (1, 10, 100, 1000)
+DEFAULT_REPORT = 'benchmark_report.json'
+
+# Version du format du rapport, incrémentée si sa structure change
+REPORT_VERSION = 1
+
+# Écart type (en degrés) du décalage des coordonnées des centrales synthétiques
+JITTER_DEGREES = 0.05
+
+def load_payloads(directory=PAYLOAD_DIR):
+    """Charge les enregistrements des réponses enregistrées : {jeu de données: liste d'enregistrements}."""
+    payloads = {}
+    for dataset in DATASETS:
+        with open(os.path.join(directory, f"{dataset}.json"), encoding='utf-8') as f:
+            payloads[dataset] = json.load(f)['results']
+    return payloads
+
+def scale_records(dataset, records, factor, seed=0):
+    """Multiplie les enregistrements d'un jeu de données par factor.
+
+    Chaque copie reçoit un nom de centrale distinct et des coordonnées légèrement décalées,
+    pour que les regroupements et les empreintes restent représentatifs.
+    """
+    if factor == 1:
+        return list(records)
+    rng = random.Random(seed)
+    coordinates = DATASET_SCHEMAS[dataset]['coordinates']
+    scaled = list(records)
+    for copy in range(1, factor):
+        for record in records:
+            record = dict(record, centrale=f"{record['centrale']} {copy}")
+            point = record.get(coordinates)
+            if point:
+                record[coordinates] = {
+                    'lon': round(point['lon'] + rng.gauss(0, JITTER_DEGREES), 6),
+                    'lat': round(point['lat'] + rng.gauss(0, JITTER_DEGREES), 6),
+                }
+            scaled.append(record)
+    return scaled
+
+class FakeOpendatasoft:
+    """Serveur local imitant les endpoints /records et /exports/jsonl de l'API Opendatasoft Explore v2.1.
+
+    Chaque réponse est retardée de latency secondes. Comme l'API réelle, /records refuse une page de
+    plus de max_page_size enregistrements ou dépassant max_offset (réponse 400). Seul le filtre
+    where de la forme "champ >= date'...'" est interprété.
+    """
+
+    def __init__(self, records, latency=0.0, max_page_size=PAGE_SIZE, max_offset=MAX_RECORDS_OFFSET,
+                 host='127.0.0.1', port=0):
+        self.records = {dataset_id(dataset): rows for dataset, rows in records.items()}
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.max_offset = max_offset
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/explore/v2.1/catalog/datasets"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                status, body = fake.respond(self.path)
+                self.send_body(status, body)
+
+        return Handler
+
+    def respond(self, target):
+        """Renvoie (statut, corps) pour une requête ; compte les requêtes et les erreurs."""
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(target)
+        parts = url.path.rstrip('/').split('/')
+        with self._lock:
+            self.requests += 1
+
+        status, body = 404, b'{"error": "not found"}'
+        if 'datasets' in parts and parts.index('datasets') + 1 < len(parts):
+            rows = self.records.get(parts[parts.index('datasets') + 1])
+            query = parse_qs(url.query)
+            if rows is not None and 'where' in query:
+                rows = _filter_since(rows, query['where'][0])
+            if rows is not None and parts[-1] == 'records':
+                limit = int(query.get('limit', ['10'])[0])
+                offset = int(query.get('offset', ['0'])[0])
+                if limit > self.max_page_size or offset + limit > self.max_offset:
+                    status, body = 400, b'{"error": "invalid limit or offset"}'
+                else:
+                    page = {'total_count': len(rows), 'results': rows[offset:offset + limit]}
+                    status, body = 200, json.dumps(page, ensure_ascii=False).encode('utf-8')
+            elif rows is not None and parts[-2:] == ['exports', 'jsonl']:
+                status, body = 200, ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+
+        if status != 200:
+            with self._lock:
+                self.errors += 1
+        return status, body
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def _filter_since(rows, where):
+    """Applique un filtre where "champ >= date'...'" à des enregistrements."""
+    match = re.fullmatch(r"\s*(\w+)\s*>=\s*date'([^']+)'\s*", where)
+    if match is None:
+        raise ValueError(f"filtre non pris en charge: {where!r}")
+    field, start = match.groups()
+    times = pd.to_datetime([row.get(field) for row in rows], utc=True, errors='coerce', format='ISO8601')
+    keep = np.asarray(times >= pd.Timestamp(start))
+    return [row for row, kept in zip(rows, keep) if kept]
+
+def _directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    )
+
+class StageTimer:
+    """Mesure la durée et le pic de mémoire allouée (tracemalloc) de chaque étape."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def measure(self, name, function, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        stage = {'seconds': round(time.perf_counter() - started, 4)}
+        if self.trace_memory:
+            stage['peak_mb'] = round((tracemalloc.get_traced_memory()[1] - baseline) / 1e6, 2)
+        self.stages[name] = stage
+        return result
+
+    def add_dataset_stages(self, collector, names=('fetch', 'normalize')):
+        """Ajoute les étapes par jeu de données mesurées par instrumentation ('fetch_hydro', 'normalize_hydro'…).
+
+        Ces étapes sont imbriquées dans celles de measure : elles portent 'nested' et ne comptent
+        pas dans la durée totale.
+        """
+        for recorded in collector.stages:
+            if recorded['stage'] in names and 'dataset' in recorded:
+                name = f"{recorded['stage']}_{recorded['dataset']}"
+                self.stages[name] = {'seconds': recorded['seconds'], 'nested': True}
+
+def run_benchmark(payloads, scale, latency=0.0, max_page_size=PAGE_SIZE, max_offset=MAX_RECORDS_OFFSET,
+                  render_mode='fast', trace_memory=True, output_dir=None, seed=0, load='streaming', export=False):
+    """Exécute la chaîne complète (téléchargement, DataFrames, carte, enregistrement) à une échelle donnée.
+
+    load='streaming' mesure load_all_dataframes, utilisé par carte_complete.py : les enregistrements
+    alimentent les constructeurs de DataFrame au fil des pages (étape 'load_all_dataframes', avec
+    export=True via l'export JSONL). load='buffered' mesure séparément le téléchargement complet
+    (fetch_all_datasets) puis chaque create_*_dataframe.
+
+    Dans les deux modes, les durées de téléchargement et de normalisation de chaque jeu de données
+    sont aussi reportées ('fetch_<jeu>', 'normalize_<jeu>'). En flux, la normalisation consomme les
+    pages au fil de leur arrivée : 'normalize_<jeu>' est compris dans 'fetch_<jeu>'.
+    """
+    records = {dataset: scale_records(dataset, rows, scale, seed) for dataset, rows in payloads.items()}
+    owns_output = output_dir is None
+    output_dir = output_dir or tempfile.mkdtemp(prefix='benchmark_carte_')
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"carte_x{scale}.html")
+    timer = StageTimer(trace_memory)
+    collector = reset_metrics()
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with FakeOpendatasoft(records, latency, max_page_size, max_offset) as server:
+            if load == 'streaming':
+                dataframes = timer.measure('load_all_dataframes', load_all_dataframes,
+                                           base_url=server.base_url, export=export)
+                data = dataframes
+            else:
+                data = timer.measure('fetch', fetch_all_datasets, base_url=server.base_url)
+        if any(value is None for value in data.values()):
+            raise RuntimeError(f"échec du téléchargement ({server.errors} réponse(s) en erreur)")
+
+        if load != 'streaming':
+            dataframes = {
+                dataset: timer.measure(builder.__name__, builder, data[dataset])
+                for dataset, builder in DATAFRAME_BUILDERS.items()
+            }
+        del data
+        timer.add_dataset_stages(collector)
+        m = timer.measure('create_combined_map', create_combined_map,
+                          dataframes['hydro'], dataframes['nuclear'], dataframes['flamme'],
+                          render_mode=render_mode, data_dir=f"carte_x{scale}_data")
+        timer.measure('save', save_map, m, output_path)
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 1e6, 2) if trace_memory else None
+
+        data_dir = os.path.join(output_dir, f"carte_x{scale}_data")
+        return {
+            'scale': scale,
+            'records': {dataset: len(rows) for dataset, rows in records.items()},
+            'requests': server.requests,
+            'errors': server.errors,
+            'stages': timer.stages,
+            'total_seconds': round(sum(stage['seconds'] for stage in timer.stages.values()
+                                       if not stage.get('nested')), 4),
+            'peak_mb': peak_mb,
+            'html_bytes': os.path.getsize(output_path),
+            'data_bytes': _directory_size(data_dir) if os.path.isdir(data_dir) else 0,
+        }
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        if owns_output:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+def build_report(results, config):
+    return {
+        'report_version': REPORT_VERSION,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'folium': folium.__version__,
+        },
+        'config': config,
+        'results': results,
+    }
+
+def compare_reports(previous, current):
+    """Rapports de durée (actuel / précédent) par échelle et par étape, ainsi que de la taille HTML."""
+    previous_results = {result['scale']: result for result in previous['results']}
+    comparison = {}
+    for result in current['results']:
+        before = previous_results.get(result['scale'])
+        if before is None:
+            continue
+        ratios = {
+            stage: round(values['seconds'] / before['stages'][stage]['seconds'], 2)
+            for stage, values in result['stages'].items()
+            if before['stages'].get(stage, {}).get('seconds')
+        }
+        if before['total_seconds']:
+            ratios['total'] = round(result['total_seconds'] / before['total_seconds'], 2)
+        if before['html_bytes']:
+            ratios['html_bytes'] = round(result['html_bytes'] / before['html_bytes'], 2)
+        comparison[result['scale']] = ratios
+    return comparison
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark de la génération de la carte à partir d'un serveur Opendatasoft local."
+    )
+    parser.add_argument('--scales', type=int, nargs='+', default=list(DEFAULT_SCALES),
+                        help="facteurs multiplicateurs des jeux de données enregistrés")
+    parser.add_argument('--latency', type=float, default=0.0, help="latence (s) de chaque réponse du serveur local")
+    parser.add_argument('--max-page-size', type=int, default=PAGE_SIZE,
+                        help="taille de page maximale acceptée par /records")
+    parser.add_argument('--max-offset', type=int, default=MAX_RECORDS_OFFSET,
+                        help="profondeur de pagination maximale acceptée par /records")
+    parser.add_argument('--load', choices=('streaming', 'buffered'), default='streaming',
+                        help="'streaming' : chargement en flux de carte_complete.py (load_all_dataframes) ; "
+                             "'buffered' : téléchargement complet puis construction des DataFrames")
+    parser.add_argument('--export', action='store_true',
+                        help="lire les jeux de données via l'export JSONL (chargement 'streaming')")
+    parser.add_argument('--render', choices=RENDER_MODES, default='fast',
+                        help="mode de rendu de la carte (voir carte_complete.py --render)")
+    parser.add_argument('--payloads', default=PAYLOAD_DIR, help="répertoire des réponses enregistrées")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="ne pas mesurer la mémoire (tracemalloc ralentit les étapes)")
+    parser.add_argument('--output-dir', help="conserver les cartes générées dans ce répertoire")
+    parser.add_argument('--report', default=DEFAULT_REPORT, help="fichier JSON du rapport")
+    parser.add_argument('--compare', metavar='RAPPORT', help="comparer les résultats à un rapport précédent")
+    args = parser.parse_args(argv)
+
+    payloads = load_payloads(args.payloads)
+    results = []
+    for scale in args.scales:
+        result = run_benchmark(payloads, scale, args.latency, args.max_page_size, args.max_offset,
+                               args.render, not args.no_memory, args.output_dir,
+                               load=args.load, export=args.export)
+        results.append(result)
+        summary = [', '.join(f"{stage} {values['seconds']:.3f} s" for stage, values in result['stages'].items()),
+                   f"HTML {result['html_bytes'] / 1e6:.2f} Mo"]
+        if result['peak_mb'] is not None:
+            summary.append(f"pic mémoire {result['peak_mb']} Mo")
+        print(f"x{scale} ({sum(result['records'].values())} centrales): " + ' ; '.join(summary))
+
+    config = {
+        'latency': args.latency,
+        'max_page_size': args.max_page_size,
+        'max_offset': args.max_offset,
+        'render': args.render,
+        'load': args.load,
+        'export': args.export,
+        'trace_memory': not args.no_memory,
+    }
+    report = build_report(results, config)
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Rapport enregistré dans '{args.report}'")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous.get('config') != config:
+            print("Attention : configuration différente de celle du rapport comparé")
+        for scale, ratios in compare_reports(previous, report).items():
+            print(f"x{scale} (actuel / précédent): " + ', '.join(f"{name} {ratio}" for name, ratio in ratios.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Durée pendant laquelle une réponse en cache est réutilisée sans revalidation
+DEFAULT_TTL = 24 * 3600
+# Taille maximale du cache sur disque avant éviction des entrées les moins récemment utilisées
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+class CacheMiss(requests.exceptions.RequestException):
+    """Levée en mode hors ligne lorsqu'une réponse n'est pas présente dans le cache."""
+
+class HttpCache:
+    """Cache disque des réponses HTTP de l'API EDF.
+
+    Chaque réponse est stockée avec son ETag/Last-Modified. Une entrée plus récente que le TTL
+    est réutilisée telle quelle ; au-delà, elle est revalidée par une requête conditionnelle
+    (une réponse 304 conserve le corps en cache). En mode hors ligne, seules les entrées en cache
+    sont utilisées. Le cache est limité en taille : evict(), appelé une fois les téléchargements
+    terminés, supprime en premier les entrées les moins récemment utilisées.
+    """
+
+    def __init__(self, directory='.cache_edf', ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, url, params):
+        """Renvoie les chemins (corps, métadonnées) associés à une requête."""
+        key = json.dumps([url, sorted((params or {}).items())], ensure_ascii=False)
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, digest)
+        return base + '.body', base + '.meta.json'
+
+    def _read_meta(self, body_path, meta_path):
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        with self._lock:
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+    def _touch(self, body_path):
+        """Marque une entrée comme récemment utilisée pour l'éviction LRU."""
+        try:
+            os.utime(body_path)
+        except OSError:
+            pass
+
+    def fetch(self, session, url, params=None, timeout=None):
+        """Renvoie le chemin du fichier contenant le corps de la réponse, en le téléchargeant si nécessaire."""
+        body_path, meta_path = self._paths(url, params)
+        meta = self._read_meta(body_path, meta_path)
+
+        if self.offline:
+            if meta is None:
+                raise CacheMiss(f"Réponse absente du cache hors ligne: {url} {params or ''}")
+            self._touch(body_path)
+            return body_path
+
+        if meta is not None and time.time() - meta['fetched_at'] < self.ttl:
+            self._touch(body_path)
+            return body_path
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            with session.get(url, params=params, headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code == 304 and meta is not None:
+                    meta['fetched_at'] = time.time()
+                    self._write_meta(meta_path, meta)
+                    self._touch(body_path)
+                    return body_path
+
+                response.raise_for_status()
+
+                # Écrire dans un fichier temporaire puis le renommer pour ne jamais exposer un corps partiel
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            f.write(chunk)
+                    os.replace(tmp_path, body_path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+
+                meta = {
+                    'url': url,
+                    'params': params or {},
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.time(),
+                    'size': os.path.getsize(body_path),
+                }
+        except requests.exceptions.RequestException as e:
+            if meta is None:
+                raise
+            # L'API est indisponible : réutiliser la dernière version connue
+            logger.warning("API indisponible, utilisation de la réponse en cache pour %s: %s", url, e)
+            self._touch(body_path)
+            return body_path
+
+        self._write_meta(meta_path, meta)
+        return body_path
+
+    def evict(self):
+        """Supprime les entrées les moins récemment utilisées jusqu'à repasser sous max_bytes."""
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.body'):
+                    continue
+                body_path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(body_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, body_path))
+                total += stat.st_size
+
+            for _, size, body_path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for path in (body_path, body_path[:-len('.body')] + '.meta.json'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
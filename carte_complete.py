@@ -1,147 +1,501 @@
+import argparse
+import cProfile
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import tracemalloc
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 import folium
+import numpy as np
 import pandas as pd
 import requests
+from branca.element import MacroElement
 from folium.plugins import MarkerCluster
+from jinja2 import Template
+from pandas.api.types import union_categoricals
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_hydro_data():
-    """Récupère les données des centrales hydrauliques depuis l'API EDF."""
-    url = "https://opendata.edf.fr/api/explore/v2.1/catalog/datasets/centrales-de-production-hydraulique-de-edf-sa/records"
+from cache_http import DEFAULT_MAX_BYTES, DEFAULT_TTL, HttpCache
+from clusters import ClusterLayers, ZoomClusters, remove_tiles
+from empreintes import (PLANT_KEYS, diff_fingerprints, fingerprint_dataframe, load_build_state,
+                        save_build_state, write_change_summary)
+from instrumentation import configure_logging, reset_metrics, stage
+from snapshots import SNAPSHOT_DIR, load_snapshot, write_snapshot
+
+try:
+    import brotli
+except ImportError:  # compression Brotli facultative
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Point d'entrée de l'API Explore v2.1 d'Opendatasoft utilisée par opendata.edf.fr
+API_BASE_URL = "https://opendata.edf.fr/api/explore/v2.1/catalog/datasets"
+
+# Jeux de données EDF utilisés par la carte
+DATASETS = {
+    'hydro': {
+        'id': "centrales-de-production-hydraulique-de-edf-sa",
+        'label': "hydraulique",
+    },
+    'nuclear': {
+        'id': "centrales-de-production-nucleaire-edf",
+        'label': "nucléaire",
+    },
+    'flamme': {
+        'id': "centrales-de-production-thermique-a-flamme-d-edf-sa-fioul-gaz-charbon",
+        'label': "thermique",
+    },
+}
+
+# Délais (connexion, lecture) en secondes appliqués à chaque requête
+REQUEST_TIMEOUT = (5, 30)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# L'endpoint /records plafonne la taille des pages et la profondeur de pagination
+PAGE_SIZE = 100
+MAX_RECORDS_OFFSET = 10000
+
+def create_session(pool_size=len(DATASETS), retries=MAX_RETRIES, backoff_factor=RETRY_BACKOFF):
+    """Crée une session HTTP partagée (keep-alive) avec pool de connexions et relances bornées."""
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET'])
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
     
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        total_count = response.json().get('total_count', 0)
-        
-        response = requests.get(url, params={"limit": total_count})
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def dataset_id(dataset):
+    """Identifiant Opendatasoft d'un jeu de données de DATASETS, ou l'identifiant lui-même."""
+    return DATASETS[dataset]['id'] if dataset in DATASETS else dataset
+
+def iter_records(dataset, session, base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, page_size=PAGE_SIZE, cache=None,
+                 metrics=None, params=None):
+    """Parcourt l'endpoint /records page par page et renvoie les enregistrements un à un.
+    
+    La page suivante est téléchargée pendant que la page courante est consommée.
+    Si le jeu de données dépasse la profondeur de pagination autorisée, l'export JSONL est utilisé.
+    Avec un cache (HttpCache), chaque page est servie depuis le disque ou revalidée.
+    Le nombre de requêtes et d'octets lus est ajouté à metrics (instrumentation.Stage) s'il est fourni.
+    params ajoute des paramètres de requête (where, select...) à chaque page et à l'export.
+    """
+    url = f"{base_url}/{dataset_id(dataset)}/records"
+    
+    def fetch_page(offset):
+        page_params = {**(params or {}), "limit": page_size, "offset": offset}
+        if cache is not None:
+            path = cache.fetch(session, url, page_params, timeout)
+            if metrics is not None:
+                metrics.add('requests', 1)
+                metrics.add('bytes', os.path.getsize(path))
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        response = session.get(url, params=page_params, timeout=timeout)
         response.raise_for_status()
+        if metrics is not None:
+            metrics.add('requests', 1)
+            metrics.add('bytes', len(response.content))
         return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Erreur lors de la requête API hydraulique: {e}")
-        return None
+    
+    page = fetch_page(0)
+    total_count = page.get('total_count', 0)
+    if total_count > MAX_RECORDS_OFFSET:
+        yield from iter_export_records(dataset, session, base_url, timeout, cache, metrics, params)
+        return
+    
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        offset = 0
+        while True:
+            results = page.get('results', [])
+            offset += len(results)
+            next_page = None
+            if results and offset < total_count:
+                next_page = prefetcher.submit(fetch_page, offset)
+            
+            yield from results
+            
+            if next_page is None:
+                break
+            page = next_page.result()
 
-def get_nuclear_data():
-    """Récupère les données des centrales nucléaires depuis l'API EDF."""
-    url = "https://opendata.edf.fr/api/explore/v2.1/catalog/datasets/centrales-de-production-nucleaire-edf/records"
+def iter_export_records(dataset, session, base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, cache=None, metrics=None,
+                        params=None):
+    """Lit l'export JSONL d'un jeu de données en flux, sans charger la réponse complète en mémoire."""
+    url = f"{base_url}/{dataset_id(dataset)}/exports/jsonl"
+    if metrics is not None:
+        metrics.add('requests', 1)
     
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        total_count = response.json().get('total_count', 0)
-        
-        response = requests.get(url, params={"limit": total_count})
+    if cache is not None:
+        path = cache.fetch(session, url, params, timeout=timeout)
+        if metrics is not None:
+            metrics.add('bytes', os.path.getsize(path))
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    
+    with session.get(url, params=params, stream=True, timeout=timeout) as response:
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Erreur lors de la requête API nucléaire: {e}")
-        return None
+        for line in response.iter_lines():
+            if metrics is not None:
+                metrics.add('bytes', len(line) + 1)
+            if line:
+                yield json.loads(line)
 
-def get_flamme_data():
-    """Récupère les données des centrales thermiques à flamme depuis l'API EDF."""
-    url = "https://opendata.edf.fr/api/explore/v2.1/catalog/datasets/centrales-de-production-thermique-a-flamme-d-edf-sa-fioul-gaz-charbon/records"
+def get_dataset_data(dataset, session=None, base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, cache=None):
+    """Récupère l'ensemble des enregistrements d'un jeu de données EDF ('hydro', 'nuclear' ou 'flamme')."""
+    owns_session = session is None
+    if owns_session:
+        session = create_session(pool_size=1)
     
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        total_count = response.json().get('total_count', 0)
-        
-        response = requests.get(url, params={"limit": total_count})
-        response.raise_for_status()
-        return response.json()
+        with stage('fetch', dataset=dataset) as metrics:
+            results = list(iter_records(dataset, session, base_url, timeout, cache=cache, metrics=metrics))
+            metrics['rows'] = len(results)
+        return {'total_count': len(results), 'results': results}
     except requests.exceptions.RequestException as e:
-        print(f"Erreur lors de la requête API thermique: {e}")
+        logger.error("Erreur lors de la requête API %s: %s", DATASETS[dataset]['label'], e,
+                     extra={'fields': {'dataset': dataset}})
         return None
+    finally:
+        if owns_session:
+            session.close()
 
-def create_hydro_dataframe(data):
-    if not data or 'results' not in data:
-        return None
+def get_hydro_data(session=None, base_url=API_BASE_URL, cache=None):
+    """Récupère les données des centrales hydrauliques depuis l'API EDF."""
+    return get_dataset_data('hydro', session=session, base_url=base_url, cache=cache)
+
+def get_nuclear_data(session=None, base_url=API_BASE_URL, cache=None):
+    """Récupère les données des centrales nucléaires depuis l'API EDF."""
+    return get_dataset_data('nuclear', session=session, base_url=base_url, cache=cache)
+
+def get_flamme_data(session=None, base_url=API_BASE_URL, cache=None):
+    """Récupère les données des centrales thermiques à flamme depuis l'API EDF."""
+    return get_dataset_data('flamme', session=session, base_url=base_url, cache=cache)
+
+def fetch_all_datasets(datasets=tuple(DATASETS), base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, cache=None):
+    """Récupère les jeux de données en parallèle sur une seule session HTTP partagée.
     
-    centrales = []
-    for centrale in data['results']:
-        point_gps = centrale.get('point_gps_wsg_84', {})
-        lat = point_gps.get('lat') if isinstance(point_gps, dict) else None
-        lon = point_gps.get('lon') if isinstance(point_gps, dict) else None
-        
-        centrale_info = {
-            'Centrale': centrale.get('centrale'),
-            'Type': 'Hydraulique',
-            'Filière': centrale.get('filiere'),
-            'Catégorie': centrale.get('categorie_centrale'),
-            'Puissance (MW)': centrale.get('puissance_installee'),
-            'Département': centrale.get('departement'),
-            'Commune': centrale.get('commune'),
-            'Année mise en service': centrale.get('annee_de_mise_en_service'),
-            'Latitude': lat,
-            'Longitude': lon
-        }
-        centrales.append(centrale_info)
+    La durée totale est celle du jeu de données le plus lent, et non la somme des requêtes.
+    Renvoie un dictionnaire {jeu de données: données JSON ou None en cas d'erreur}.
+    """
+    with create_session(pool_size=len(datasets)) as session:
+        with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+            futures = {
+                dataset: executor.submit(get_dataset_data, dataset, session, base_url, timeout, cache)
+                for dataset in datasets
+            }
+            return {dataset: future.result() for dataset, future in futures.items()}
+
+# Schéma de normalisation de chaque jeu de données : colonnes du DataFrame -> champs de l'API
+DATASET_SCHEMAS = {
+    'hydro': {
+        'coordinates': 'point_gps_wsg_84',
+        'constants': {'Type': 'Hydraulique'},
+        'columns': {
+            'Centrale': 'centrale',
+            'Filière': 'filiere',
+            'Catégorie': 'categorie_centrale',
+            'Puissance (MW)': 'puissance_installee',
+            'Département': 'departement',
+            'Commune': 'commune',
+            'Année mise en service': 'annee_de_mise_en_service',
+        },
+    },
+    'nuclear': {
+        'coordinates': 'point_gps_wsg84',
+        'constants': {'Type': 'Nucléaire'},
+        'columns': {
+            'Centrale': 'centrale',
+            'Filière': 'filiere',
+            'Catégorie': 'sous_filiere',
+            'Puissance (MW)': 'puissance_installee',
+            'Combustible': 'combustible',
+            'Date mise en service': 'date_de_mise_en_service_industrielle',
+            'Région': 'region',
+        },
+    },
+    'flamme': {
+        'coordinates': 'point_gps_wsg84',
+        'constants': {},
+        'columns': {
+            'Centrale': 'centrale',
+            'Tranche': 'tranche',
+            'Filière': 'filiere',
+            'Sous-filière': 'sous_filiere',
+            'Combustible': 'combustible',
+            'Puissance (MW)': 'puissance_installee',
+            'Date mise en service': 'date_de_mise_en_service_industrielle',
+            'Région': 'region',
+            'Département': 'departement',
+            'Commune': 'commune',
+        },
+    },
+}
+
+# Types compacts appliqués aux colonnes normalisées ('datetime' : date analysée)
+COLUMN_DTYPES = {
+    'Type': 'category',
+    'Filière': 'category',
+    'Sous-filière': 'category',
+    'Catégorie': 'category',
+    'Combustible': 'category',
+    'Région': 'category',
+    'Département': 'category',
+    'Puissance (MW)': 'float32',
+    'Latitude': 'float32',
+    'Longitude': 'float32',
+    'Année mise en service': 'Int16',
+    'Date mise en service': 'datetime',
+}
+
+# Qualité Brotli des fichiers de couches : sur une couche de 1,5 Mo, la qualité 9 compresse en 0,08 s
+# (mieux que gzip -9) ; la qualité 11 par défaut gagne encore un tiers mais prend 60 fois plus de temps
+BROTLI_QUALITY = 9
+
+# Nombre d'enregistrements normalisés à la fois
+NORMALIZE_CHUNK_SIZE = 50000
+
+def _iter_results(data):
+    """Renvoie les enregistrements d'une réponse JSON complète ou d'un itérable d'enregistrements."""
+    if isinstance(data, dict):
+        return data.get('results')
+    return data
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _extract_coordinate(points, key):
+    """Extrait 'lat' ou 'lon' d'une colonne de points GPS ; les valeurs absentes ou invalides donnent NaN."""
+    if points.dtype != object:
+        return pd.Series(np.nan, index=points.index)
+    return pd.to_numeric(points.str.get(key), errors='coerce')
+
+def _apply_dtypes(df):
+    for column, dtype in COLUMN_DTYPES.items():
+        if column not in df:
+            continue
+        if dtype == 'datetime':
+            df[column] = pd.to_datetime(df[column], errors='coerce', format='ISO8601')
+        elif dtype == 'category':
+            df[column] = df[column].astype(object).astype('category')
+        else:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+    return df
+
+def _normalize_chunk(records, schema):
+    """Normalise un lot d'enregistrements colonne par colonne selon le schéma du jeu de données."""
+    columns = schema['columns']
+    coordinates = schema['coordinates']
+    raw = pd.DataFrame.from_records(records, columns=[*columns.values(), coordinates])
     
-    return pd.DataFrame(centrales)
+    df = pd.DataFrame({name: raw[field] for name, field in columns.items()})
+    for name, value in schema['constants'].items():
+        df[name] = value
+    df['Latitude'] = _extract_coordinate(raw[coordinates], 'lat')
+    df['Longitude'] = _extract_coordinate(raw[coordinates], 'lon')
+    return _apply_dtypes(df)
 
-def create_nuclear_dataframe(data):
-    if not data or 'results' not in data:
-        return None
+def _concat_chunks(chunks):
+    """Concatène des lots normalisés en conservant les colonnes catégorielles."""
+    if len(chunks) == 1:
+        return chunks[0]
     
-    centrales = []
-    for centrale in data['results']:
-        point_gps = centrale.get('point_gps_wsg84', {})
-        lat = point_gps.get('lat') if isinstance(point_gps, dict) else None
-        lon = point_gps.get('lon') if isinstance(point_gps, dict) else None
-        
-        sous_filiere = centrale.get('sous_filiere')
-        print(f"Catégorie nucléaire trouvée : {sous_filiere}")
-        
-        centrale_info = {
-            'Centrale': centrale.get('centrale'),
-            'Type': 'Nucléaire',
-            'Filière': centrale.get('filiere'),
-            'Catégorie': sous_filiere,
-            'Puissance (MW)': centrale.get('puissance_installee'),
-            'Combustible': centrale.get('combustible'),
-            'Date mise en service': centrale.get('date_de_mise_en_service_industrielle'),
-            'Région': centrale.get('region'),
-            'Latitude': lat,
-            'Longitude': lon
-        }
-        centrales.append(centrale_info)
+    columns = chunks[0].columns
+    categorical = [c for c in columns if isinstance(chunks[0][c].dtype, pd.CategoricalDtype)]
+    df = pd.concat([chunk.drop(columns=categorical) for chunk in chunks], ignore_index=True)
+    for column in categorical:
+        df[column] = union_categoricals([chunk[column] for chunk in chunks])
+    return df[columns]
+
+def normalize_records(records, schema, chunk_size=NORMALIZE_CHUNK_SIZE):
+    """Construit un DataFrame typé à partir d'un itérable d'enregistrements de l'API.
+    
+    Les enregistrements sont traités par lots : la mémoire de travail ne dépend que de chunk_size.
+    Renvoie None si aucun enregistrement n'est disponible.
+    """
+    if records is None:
+        return None
     
-    df = pd.DataFrame(centrales)
-    print("\nCatégories uniques de réacteurs nucléaires:")
-    print(df['Catégorie'].unique())
+    chunks = [_normalize_chunk(batch, schema) for batch in _batched(records, chunk_size)]
+    if not chunks:
+        return None
+    return _concat_chunks(chunks)
+
+def _normalize_dataset(dataset, data):
+    with stage('normalize', dataset=dataset) as metrics:
+        df = normalize_records(_iter_results(data), DATASET_SCHEMAS[dataset])
+        metrics['rows'] = 0 if df is None else len(df)
     return df
 
+def create_hydro_dataframe(data):
+    return _normalize_dataset('hydro', data)
+
+def create_nuclear_dataframe(data):
+    return _normalize_dataset('nuclear', data)
+
 def create_flamme_dataframe(data):
-    if not data or 'results' not in data:
-        return None
+    return _normalize_dataset('flamme', data)
+
+# Constructeurs de DataFrame associés à chaque jeu de données
+DATAFRAME_BUILDERS = {
+    'hydro': create_hydro_dataframe,
+    'nuclear': create_nuclear_dataframe,
+    'flamme': create_flamme_dataframe,
+}
+
+def load_dataframe(dataset, session, base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, export=False, cache=None):
+    """Construit le DataFrame d'un jeu de données à partir de ses enregistrements lus en flux.
     
-    centrales = []
-    for centrale in data['results']:
-        point_gps = centrale.get('point_gps_wsg84', {})
-        lat = point_gps.get('lat') if isinstance(point_gps, dict) else None
-        lon = point_gps.get('lon') if isinstance(point_gps, dict) else None
-        
-        centrale_info = {
-            'Centrale': centrale.get('centrale'),
-            'Tranche': centrale.get('tranche'),
-            'Filière': centrale.get('filiere'),
-            'Sous-filière': centrale.get('sous_filiere'),
-            'Combustible': centrale.get('combustible'),
-            'Puissance (MW)': centrale.get('puissance_installee'),
-            'Date mise en service': centrale.get('date_de_mise_en_service_industrielle'),
-            'Région': centrale.get('region'),
-            'Département': centrale.get('departement'),
-            'Commune': centrale.get('commune'),
-            'Latitude': lat,
-            'Longitude': lon
-        }
-        centrales.append(centrale_info)
+    Les pages (ou les lignes de l'export JSONL si export=True) alimentent directement
+    le constructeur : la réponse complète n'est jamais chargée en mémoire. L'étape 'fetch'
+    mesurée englobe donc la normalisation ('normalize').
+    """
+    try:
+        with stage('fetch', dataset=dataset, streaming=True) as metrics:
+            if export:
+                records = iter_export_records(dataset, session, base_url, timeout, cache, metrics)
+            else:
+                records = iter_records(dataset, session, base_url, timeout, cache=cache, metrics=metrics)
+            df = DATAFRAME_BUILDERS[dataset](records)
+            metrics['rows'] = 0 if df is None else len(df)
+        return df
+    except requests.exceptions.RequestException as e:
+        logger.error("Erreur lors de la requête API %s: %s", DATASETS[dataset]['label'], e,
+                     extra={'fields': {'dataset': dataset}})
+        return None
+
+def load_all_dataframes(datasets=tuple(DATASETS), base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, export=False, cache=None):
+    """Récupère et normalise les jeux de données en parallèle sur une session HTTP partagée.
     
-    return pd.DataFrame(centrales)
+    Renvoie un dictionnaire {jeu de données: DataFrame ou None en cas d'erreur}.
+    """
+    with create_session(pool_size=2 * len(datasets)) as session:
+        with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+            futures = {
+                dataset: executor.submit(load_dataframe, dataset, session, base_url, timeout, export, cache)
+                for dataset in datasets
+            }
+            return {dataset: future.result() for dataset, future in futures.items()}
 
-def create_combined_map(df_hydro, df_nuclear, df_flamme):
-    """Crée une carte interactive combinant les centrales hydrauliques, nucléaires et thermiques."""
-    # Créer la carte centrée sur la France
-    m = folium.Map(location=[46.6034, 1.8883], zoom_start=6)
+# Champs affichés dans les popups de chaque type de centrale : (libellé, colonne, unité)
+POPUP_FIELDS = {
+    'hydro': [
+        ("Type", 'Type', ''),
+        ("Filière", 'Filière', ''),
+        ("Puissance", 'Puissance (MW)', ' MW'),
+        ("Catégorie", 'Catégorie', ''),
+        ("Département", 'Département', ''),
+        ("Commune", 'Commune', ''),
+        ("Année de mise en service", 'Année mise en service', ''),
+    ],
+    'nuclear': [
+        ("Type", 'Type', ''),
+        ("Filière", 'Filière', ''),
+        ("Puissance", 'Puissance (MW)', ' MW'),
+        ("Type de réacteur", 'Catégorie', ''),
+        ("Combustible", 'Combustible', ''),
+        ("Région", 'Région', ''),
+        ("Date de mise en service", 'Date mise en service', ''),
+    ],
+    'flamme': [
+        ("Type", 'Filière', ''),
+        ("Sous-type", 'Sous-filière', ''),
+        ("Combustible", 'Combustible', ''),
+        ("Puissance", 'Puissance (MW)', ' MW'),
+        ("Région", 'Région', ''),
+        ("Département", 'Département', ''),
+        ("Commune", 'Commune', ''),
+        ("Date de mise en service", 'Date mise en service', ''),
+    ],
+}
+
+MISSING_VALUE = "Non renseigné"
+
+# Nombre de décimales conservées pour les coordonnées envoyées au navigateur (~1 m)
+COORDINATE_DECIMALS = 5
+
+def _js_payload(value):
+    """Sérialise des données en JSON compact à insérer dans un script de la page."""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+
+def _format_column(series, unit='', missing=MISSING_VALUE):
+    """Formate une colonne entière pour l'affichage dans les popups."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        formatted = series.dt.strftime('%d/%m/%Y')
+    elif pd.api.types.is_float_dtype(series):
+        formatted = series.map(lambda value: f"{value:g}{unit}", na_action='ignore')
+    else:
+        formatted = series.astype(object).map(lambda value: f"{value}{unit}", na_action='ignore')
+    return formatted.astype(object).where(series.notna(), missing)
+
+def _plant_names(df, plant_type):
+    """Renvoie les noms affichés (info-bulles et titres de popup) des centrales."""
+    if plant_type == 'flamme':
+        return df['Centrale'].astype(str) + " - " + df['Tranche'].astype(str)
+    return df['Centrale'].astype(object)
+
+def build_popups(df, plant_type):
+    """Construit le contenu HTML des popups d'un DataFrame, colonne par colonne."""
+    fields = POPUP_FIELDS[plant_type]
+    names = _plant_names(df, plant_type)
+    columns = [_format_column(df[column], unit) for _, column, unit in fields]
     
+    popups = []
+    for name, *values in zip(names, *columns):
+        lines = [f"<b>{name}</b>"]
+        lines.extend(f"{label}: {value}" for (label, _, _), value in zip(fields, values))
+        popups.append("<br>".join(lines))
+    return popups
+
+def popup_template(df, plant_type):
+    """Construit le modèle de popup partagé par toutes les centrales d'un type.
+
+    Chaque champ de POPUP_FIELDS devient [libellé, unité] ; un champ dont la valeur est identique
+    pour toutes les centrales du DataFrame devient [libellé, unité, texte] et n'est plus répété
+    dans les données de chaque centrale (voir popup_values).
+    """
+    template = []
+    for label, column, unit in POPUP_FIELDS[plant_type]:
+        values = _format_column(df[column], unit)
+        if len(values) and values.nunique(dropna=False) == 1:
+            template.append([label, unit, values.iloc[0]])
+        else:
+            template.append([label, unit])
+    return template
+
+def popup_values(df, plant_type, template):
+    """Valeurs des champs variables du modèle de popup pour chaque centrale (None si non renseignée)."""
+    columns = [
+        _format_column(df[column], missing=None)
+        for (_, column, _), field in zip(POPUP_FIELDS[plant_type], template) if len(field) == 2
+    ]
+    if not columns:
+        return [[] for _ in range(len(df))]
+    return [list(values) for values in zip(*columns)]
+
+def get_layer_colors(df_hydro, df_nuclear, df_flamme):
+    """Attribue une couleur à chaque catégorie hydraulique, sous-filière nucléaire et combustible thermique."""
     # Définir les couleurs pour les centrales hydrauliques
     hydro_colors = {
         'Lac': 'blue',
@@ -152,7 +506,7 @@ def create_combined_map(df_hydro, df_nuclear, df_flamme):
     }
     
     # Obtenir la liste unique des sous-filières nucléaires
-    sous_filieres = sorted(df_nuclear['Catégorie'].unique())
+    sous_filieres = sorted(df_nuclear['Catégorie'].dropna().unique())
     
     # Créer un dictionnaire de couleurs pour les sous-filières nucléaires
     nuclear_colors = {}
@@ -160,145 +514,221 @@ def create_combined_map(df_hydro, df_nuclear, df_flamme):
     for i, sous_filiere in enumerate(sous_filieres):
         nuclear_colors[sous_filiere] = nuclear_available_colors[i % len(nuclear_available_colors)]
     
-    # Afficher les associations sous-filière-couleur
-    print("\nCouleurs attribuées aux sous-filières nucléaires:")
-    for sous_filiere, color in nuclear_colors.items():
-        print(f"- {sous_filiere}: {color}")
+    # Journaliser les associations sous-filière-couleur
+    logger.debug("Couleurs attribuées aux sous-filières nucléaires: %s", nuclear_colors,
+                 extra={'fields': {'nuclear_colors': nuclear_colors}})
     
     # Obtenir la liste unique des combustibles pour les centrales thermiques
-    combustibles = sorted(df_flamme['Combustible'].unique())
+    combustibles = sorted(df_flamme['Combustible'].dropna().unique())
     
     # Créer un dictionnaire de couleurs pour les combustibles
     available_colors = ['green', 'orange', 'pink', 'lightred', 'beige', 'lightgreen']
     flamme_colors = {combustible: available_colors[i % len(available_colors)] 
                     for i, combustible in enumerate(combustibles)}
     
-    # Créer les groupes principaux
-    hydro_group = folium.FeatureGroup(name="Centrales Hydrauliques")
-    nuclear_group = folium.FeatureGroup(name="Centrales Nucléaires")
-    flamme_group = folium.FeatureGroup(name="Centrales Thermiques")
-    
-    # Créer les sous-groupes pour l'hydraulique
-    hydro_clusters = {}
-    for category in df_hydro['Catégorie'].unique():
-        hydro_clusters[category] = MarkerCluster(name=f"Hydraulique - {category}")
-    
-    # Créer les sous-groupes pour le nucléaire
-    nuclear_clusters = {}
-    for reactor_type in df_nuclear['Catégorie'].unique():
-        nuclear_clusters[reactor_type] = MarkerCluster(name=f"Nucléaire - {reactor_type}")
-    
-    # Créer les sous-groupes pour le thermique
-    flamme_clusters = {}
-    for combustible in combustibles:
-        nom_groupe = "Thermique - Mixte" if '/' in combustible else f"Thermique - {combustible}"
-        flamme_clusters[combustible] = MarkerCluster(name=nom_groupe)
-    
-    # Ajouter les marqueurs hydrauliques
-    for idx, row in df_hydro.iterrows():
-        if pd.notna(row['Latitude']) and pd.notna(row['Longitude']):
-            category = row['Catégorie']
-            color = hydro_colors.get(category, 'blue')
-            name = row['Centrale']
-            
-            popup_content = f"""
-                <b>{name}</b><br>
-                Type: {row['Type']}<br>
-                Filière: {row['Filière']}<br>
-                Puissance: {row['Puissance (MW)']} MW<br>
-                Catégorie: {category}<br>
-                Département: {row['Département']}<br>
-                Commune: {row['Commune']}<br>
-                Année de mise en service: {row['Année mise en service']}
-            """
-            
-            marker = folium.Marker(
-                location=[row['Latitude'], row['Longitude']],
-                popup=folium.Popup(popup_content, max_width=300),
-                tooltip=name,
-                icon=folium.Icon(color=color, icon='tint')
-            )
-            
-            if category in hydro_clusters:
-                marker.add_to(hydro_clusters[category])
-    
-    # Ajouter les marqueurs nucléaires
-    for idx, row in df_nuclear.iterrows():
-        if pd.notna(row['Latitude']) and pd.notna(row['Longitude']):
-            reactor_type = row['Catégorie']
-            color = nuclear_colors.get(reactor_type, 'red')
-            name = row['Centrale']
-            
-            popup_content = f"""
-                <b>{name}</b><br>
-                Type: {row['Type']}<br>
-                Filière: {row['Filière']}<br>
-                Puissance: {row['Puissance (MW)']} MW<br>
-                Type de réacteur: {reactor_type}<br>
-                Combustible: {row['Combustible']}<br>
-                Région: {row['Région']}<br>
-                Date de mise en service: {row['Date mise en service']}
-            """
-            
-            marker = folium.Marker(
-                location=[row['Latitude'], row['Longitude']],
-                popup=folium.Popup(popup_content, max_width=300),
-                tooltip=name,
-                icon=folium.Icon(color=color, icon='bolt', prefix='fa')
-            )
-            
-            if reactor_type in nuclear_clusters:
-                marker.add_to(nuclear_clusters[reactor_type])
-    
-    # Ajouter les marqueurs thermiques
-    for idx, row in df_flamme.iterrows():
-        if pd.notna(row['Latitude']) and pd.notna(row['Longitude']):
-            combustible = row['Combustible']
-            color = flamme_colors[combustible]
-            name = f"{row['Centrale']} - {row['Tranche']}"
-            
-            popup_content = f"""
-                <b>{name}</b><br>
-                Type: {row['Filière']}<br>
-                Sous-type: {row['Sous-filière']}<br>
-                Combustible: {combustible}<br>
-                Puissance: {row['Puissance (MW)']} MW<br>
-                Région: {row['Région']}<br>
-                Département: {row['Département']}<br>
-                Commune: {row['Commune']}<br>
-                Date de mise en service: {row['Date mise en service']}
-            """
-            
-            icon = 'fire' if '/' not in combustible else 'industry'
-            marker = folium.Marker(
-                location=[row['Latitude'], row['Longitude']],
-                popup=folium.Popup(popup_content, max_width=300),
-                tooltip=name,
-                icon=folium.Icon(color=color, icon=icon, prefix='fa')
-            )
-            
-            if combustible in flamme_clusters:
-                marker.add_to(flamme_clusters[combustible])
+    return hydro_colors, nuclear_colors, flamme_colors
+
+def iter_plant_layers(df_hydro, df_nuclear, df_flamme, hydro_colors, nuclear_colors, flamme_colors):
+    """Découpe les centrales en couches (un cluster par catégorie) avec leur style de marqueur.
     
-    # Ajouter tous les clusters à leurs groupes respectifs
-    for cluster in hydro_clusters.values():
-        cluster.add_to(hydro_group)
+    Chaque couche est un dictionnaire : type de centrale ('hydro', 'nuclear' ou 'flamme'),
+    nom du cluster, style du marqueur (couleur, icône, préfixe) et centrales géolocalisées.
+    """
+    def located(df):
+        return df[df['Latitude'].notna() & df['Longitude'].notna()]
     
-    for cluster in nuclear_clusters.values():
-        cluster.add_to(nuclear_group)
+    df_hydro = located(df_hydro)
+    for category in df_hydro['Catégorie'].dropna().unique():
+        yield {
+            'type': 'hydro',
+            'name': f"Hydraulique - {category}",
+            'style': {'color': hydro_colors.get(category, 'blue'), 'icon': 'tint', 'prefix': 'glyphicon'},
+            'plants': df_hydro[df_hydro['Catégorie'] == category],
+        }
     
-    for cluster in flamme_clusters.values():
-        cluster.add_to(flamme_group)
+    df_nuclear = located(df_nuclear)
+    for reactor_type in df_nuclear['Catégorie'].dropna().unique():
+        yield {
+            'type': 'nuclear',
+            'name': f"Nucléaire - {reactor_type}",
+            'style': {'color': nuclear_colors.get(reactor_type, 'red'), 'icon': 'bolt', 'prefix': 'fa'},
+            'plants': df_nuclear[df_nuclear['Catégorie'] == reactor_type],
+        }
     
-    # Ajouter les groupes principaux à la carte
-    hydro_group.add_to(m)
-    nuclear_group.add_to(m)
-    flamme_group.add_to(m)
+    df_flamme = located(df_flamme)
+    for combustible, color in flamme_colors.items():
+        nom_groupe = "Thermique - Mixte" if '/' in combustible else f"Thermique - {combustible}"
+        icon = 'fire' if '/' not in combustible else 'industry'
+        yield {
+            'type': 'flamme',
+            'name': nom_groupe,
+            'style': {'color': color, 'icon': icon, 'prefix': 'fa'},
+            'plants': df_flamme[df_flamme['Combustible'] == combustible],
+        }
+
+def layer_rows(layer, template=None):
+    """Sérialise une couche en tableau compact pour le navigateur.
     
-    # Ajouter le contrôle des couches
-    folium.LayerControl().add_to(m)
+    Sans modèle de popup, chaque ligne est [lat, lon, info-bulle, popup HTML] ; avec un modèle
+    (voir popup_template), elle est [lat, lon, info-bulle, valeurs...] et la popup n'est construite
+    dans le navigateur qu'à son ouverture.
+    """
+    plants = layer['plants']
+    latitudes = plants['Latitude'].astype('float64').round(COORDINATE_DECIMALS)
+    longitudes = plants['Longitude'].astype('float64').round(COORDINATE_DECIMALS)
+    names = _plant_names(plants, layer['type'])
+    if template is None:
+        return [list(row) for row in zip(latitudes.tolist(), longitudes.tolist(), names.tolist(),
+                                         build_popups(plants, layer['type']))]
+    values = popup_values(plants, layer['type'], template)
+    return [[lat, lon, name, *row] for lat, lon, name, row in zip(
+        latitudes.tolist(), longitudes.tolist(), names.tolist(), values)]
+
+class PlantMarkers(MacroElement):
+    """Fonctions JavaScript partagées qui construisent les marqueurs d'une couche à partir de son tableau compact.
     
-    # Ajouter une légende combinée
+    templates ({type de centrale: modèle de popup}) active les popups différées : leur contenu est
+    construit à partir du modèle du type de centrale lors de leur ouverture.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var plantPopupTemplates = {{ this.templates_json }};
+
+            function plantPopup(template, row, offset) {
+                var lines = ['<b>' + row[offset] + '</b>'];
+                var next = offset + 1;
+                for (var j = 0; j < template.length; j++) {
+                    var field = template[j];
+                    if (field.length > 2) {
+                        lines.push(field[0] + ': ' + field[2]);
+                    } else {
+                        var value = row[next++];
+                        lines.push(field[0] + ': ' + (value === null ? {{ this.missing_json }} : value + field[1]));
+                    }
+                }
+                return lines.join('<br>');
+            }
+
+            function bindPlantPopup(marker, template, row, offset) {
+                if (template) {
+                    marker.bindPopup(function () { return plantPopup(template, row, offset); }, {maxWidth: 300});
+                } else {
+                    marker.bindPopup(row[offset + 1], {maxWidth: 300});
+                }
+            }
+
+            function addPlantMarkers(cluster, rows, style, template) {
+                var icon = L.AwesomeMarkers.icon({
+                    markerColor: style.color,
+                    iconColor: 'white',
+                    icon: style.icon,
+                    prefix: style.prefix,
+                    extraClasses: 'fa-rotate-0'
+                });
+                var markers = new Array(rows.length);
+                for (var i = 0; i < rows.length; i++) {
+                    var row = rows[i];
+                    var marker = L.marker([row[0], row[1]], {icon: icon});
+                    marker.bindTooltip('<div>' + row[2] + '</div>', {sticky: true});
+                    bindPlantPopup(marker, template, row, 2);
+                    markers[i] = marker;
+                }
+                cluster.addLayers(markers);
+            }
+
+            function lazyPlantLayer(group, cluster, url, style, template) {
+                var loaded = false;
+                function load() {
+                    if (loaded) {
+                        return;
+                    }
+                    loaded = true;
+                    fetch(url)
+                        .then(function (response) { return response.json(); })
+                        .then(function (rows) { addPlantMarkers(cluster, rows, style, template); })
+                        .catch(function () { loaded = false; });
+                }
+                group.on('add', load);
+                if (group._map) {
+                    load();
+                }
+            }
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, templates=None):
+        super().__init__()
+        self._name = "PlantMarkers"
+        self.templates_json = _js_payload(templates or {})
+        self.missing_json = _js_payload(MISSING_VALUE)
+
+class PlantCluster(MarkerCluster):
+    """Cluster dont les marqueurs sont générés côté navigateur par addPlantMarkers (voir PlantMarkers)."""
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.markerClusterGroup(
+                {{ this.options|tojson }}
+            );
+            addPlantMarkers({{ this.get_name() }}, {{ this.rows_json }}, {{ this.style|tojson }},
+                            plantPopupTemplates[{{ this.plant_type|tojson }}]);
+            {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, rows, style, name=None, plant_type=None, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._name = "PlantCluster"
+        self.rows_json = _js_payload(rows)
+        self.style = style
+        self.plant_type = plant_type
+
+class LazyPlantCluster(MarkerCluster):
+    """Cluster dont les données sont téléchargées la première fois que son groupe est affiché.
+    
+    Le tableau compact de la couche est enregistré dans un fichier séparé dont le nom contient
+    une empreinte du contenu (voir save_map), ce qui permet une mise en cache longue durée.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.markerClusterGroup(
+                {{ this.options|tojson }}
+            );
+            {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+            lazyPlantLayer({{ this._parent.get_name() }}, {{ this.get_name() }}, {{ this.url|tojson }}, {{ this.style|tojson }},
+                           plantPopupTemplates[{{ this.plant_type|tojson }}]);
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, rows, style, data_dir, name=None, plant_type=None, url=None, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._name = "LazyPlantCluster"
+        self.plant_type = plant_type
+        self.style = style
+        if rows is None:
+            # Couche reprise d'une construction précédente : son fichier de données existe déjà
+            self.payload = None
+            self.url = url
+        else:
+            self.payload = _js_payload(rows).encode('utf-8')
+            digest = hashlib.sha256(self.payload).hexdigest()[:12]
+            self.url = f"{data_dir}/{_slugify(name)}.{digest}.json"
+    
+    def manifest(self):
+        """Décrit la couche pour pouvoir la réutiliser lors d'une construction ultérieure."""
+        return {'type': self.plant_type, 'name': self.layer_name, 'url': self.url, 'style': self.style}
+
+def _slugify(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+def create_legend_html(hydro_colors, nuclear_colors, flamme_colors):
+    """Construit la légende combinée des trois types de centrales."""
     legend_html = '''
     <div style="position: fixed; 
                 bottom: 50px; left: 50px; 
@@ -358,61 +788,492 @@ def create_combined_map(df_hydro, df_nuclear, df_flamme):
     </div>
     '''
     
-    m.get_root().html.add_child(folium.Element(legend_html))
+    return legend_html
+
+# Modes de rendu des marqueurs et des popups (voir create_combined_map)
+RENDER_MODES = ('fast', 'markers', 'split', 'clusters')
+POPUP_MODES = ('deferred', 'inline')
+
+def create_combined_map(df_hydro, df_nuclear, df_flamme, render_mode='fast',
+                        data_dir='carte_complete_data', hidden_types=(), reuse_layers=None, popups='deferred',
+                        colors=None, production=None):
+    """Crée une carte interactive combinant les centrales hydrauliques, nucléaires et thermiques.
+    
+    render_mode='fast' sérialise chaque couche en un tableau compact dont les marqueurs sont
+    construits dans le navigateur ; render_mode='markers' génère un folium.Marker par centrale ;
+    render_mode='split' place les données de chaque couche dans un fichier de data_dir,
+    téléchargé uniquement lorsque la couche est affichée (la carte doit être enregistrée avec save_map) ;
+    render_mode='clusters' précalcule les regroupements de chaque niveau de zoom (voir clusters.py)
+    et les enregistre en tuiles statiques dans data_dir : le navigateur n'affiche que les groupes visibles.
+    Les types de centrales listés dans hidden_types sont masqués à l'ouverture.
+    En mode 'split', reuse_layers ({type de centrale: couches décrites par map_layer_manifest})
+    reprend telles quelles les couches d'une construction précédente sans les régénérer.
+    Hors mode 'markers', popups='deferred' n'envoie que les valeurs des champs de chaque centrale,
+    mises en forme par un modèle partagé par type de centrale à l'ouverture de la popup ;
+    popups='inline' inclut le HTML complet de chaque popup.
+    colors (hydro_colors, nuclear_colors, flamme_colors, comme renvoyés par get_layer_colors) impose
+    les couleurs des couches et de la légende, par exemple pour que plusieurs cartes les partagent.
+    production (images construites par production.production_frames) ajoute à chaque type de
+    centrales des cercles proportionnels à leur production, avec un curseur de période.
+    """
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f"mode de rendu inconnu: {render_mode!r} ({', '.join(RENDER_MODES)})")
+    if popups not in POPUP_MODES:
+        raise ValueError(f"mode de popups inconnu: {popups!r} ({', '.join(POPUP_MODES)})")
+    
+    # Créer la carte centrée sur la France
+    m = folium.Map(location=[46.6034, 1.8883], zoom_start=6)
+    
+    if colors is None:
+        with stage('colors'):
+            colors = get_layer_colors(df_hydro, df_nuclear, df_flamme)
+    hydro_colors, nuclear_colors, flamme_colors = colors
+    
+    # Créer les groupes principaux
+    groups = {
+        'hydro': folium.FeatureGroup(name="Centrales Hydrauliques", show='hydro' not in hidden_types),
+        'nuclear': folium.FeatureGroup(name="Centrales Nucléaires", show='nuclear' not in hidden_types),
+        'flamme': folium.FeatureGroup(name="Centrales Thermiques", show='flamme' not in hidden_types),
+    }
+    
+    templates = {}
+    if render_mode != 'markers':
+        if popups == 'deferred':
+            templates = {
+                'hydro': popup_template(df_hydro, 'hydro'),
+                'nuclear': popup_template(df_nuclear, 'nuclear'),
+                'flamme': popup_template(df_flamme, 'flamme'),
+            }
+        PlantMarkers(templates).add_to(m)
+    
+    # Reprendre les couches inchangées d'une construction précédente
+    reuse_layers = reuse_layers or {}
+    for plant_type, layers in reuse_layers.items():
+        for layer in layers:
+            LazyPlantCluster(
+                None, layer['style'], data_dir, name=layer['name'], plant_type=plant_type, url=layer['url']
+            ).add_to(groups[plant_type])
+    
+    # Créer un cluster par catégorie et l'ajouter à son groupe
+    for layer in iter_plant_layers(df_hydro, df_nuclear, df_flamme, hydro_colors, nuclear_colors, flamme_colors):
+        if render_mode == 'clusters' or layer['type'] in reuse_layers:
+            continue
+        with stage('markers', layer=layer['name'], type=layer['type'], render=render_mode) as metrics:
+            rows = layer_rows(layer, templates.get(layer['type']))
+            if render_mode == 'fast':
+                cluster = PlantCluster(rows, layer['style'], name=layer['name'], plant_type=layer['type'])
+                metrics['bytes'] = len(cluster.rows_json.encode('utf-8'))
+            elif render_mode == 'split':
+                cluster = LazyPlantCluster(rows, layer['style'], data_dir, name=layer['name'], plant_type=layer['type'])
+                metrics['bytes'] = len(cluster.payload)
+            elif render_mode == 'markers':
+                cluster = MarkerCluster(name=layer['name'])
+                for lat, lon, name, popup_content in rows:
+                    folium.Marker(
+                        location=[lat, lon],
+                        popup=folium.Popup(popup_content, max_width=300),
+                        tooltip=name,
+                        icon=folium.Icon(**layer['style'])
+                    ).add_to(cluster)
+            cluster.add_to(groups[layer['type']])
+            metrics['rows'] = len(rows)
+    
+    # Ajouter les groupes principaux à la carte
+    for group in groups.values():
+        group.add_to(m)
+    
+    if render_mode == 'clusters':
+        add_cluster_layers(m, groups, df_hydro, df_nuclear, df_flamme,
+                           hydro_colors, nuclear_colors, flamme_colors, data_dir, templates)
+    
+    if production is not None:
+        from production import ProductionLayer
+        
+        ProductionLayer(production, groups).add_to(m)
+    
+    # Ajouter le contrôle des couches
+    folium.LayerControl().add_to(m)
+    
+    # Ajouter une légende combinée
+    with stage('legend'):
+        legend_html = create_legend_html(hydro_colors, nuclear_colors, flamme_colors)
+        m.get_root().html.add_child(folium.Element(legend_html))
     
     return m
 
-def main():
-    # Récupérer les données hydrauliques
-    hydro_data = get_hydro_data()
-    if hydro_data:
-        print(f"Nombre total de centrales hydrauliques: {hydro_data.get('total_count', 0)}")
-        
-        # Créer le DataFrame hydraulique
-        df_hydro = create_hydro_dataframe(hydro_data)
-        if df_hydro is None:
-            print("Erreur lors de la création du DataFrame hydraulique")
-            return
+def add_cluster_layers(m, groups, df_hydro, df_nuclear, df_flamme,
+                       hydro_colors, nuclear_colors, flamme_colors, data_dir, templates=None):
+    """Précalcule les regroupements de toutes les couches et ajoute leur affichage par tuiles à la carte."""
+    layers = []
+    latitudes, longitudes, capacities, codes = [], [], [], []
+    plants = []
+    for code, layer in enumerate(iter_plant_layers(df_hydro, df_nuclear, df_flamme,
+                                                   hydro_colors, nuclear_colors, flamme_colors)):
+        layers.append({'type': layer['type'], 'name': layer['name'], 'style': layer['style']})
+        df = layer['plants']
+        latitudes.append(df['Latitude'].to_numpy(dtype='float64'))
+        longitudes.append(df['Longitude'].to_numpy(dtype='float64'))
+        capacities.append(df['Puissance (MW)'].to_numpy(dtype='float64', na_value=np.nan))
+        codes.append(np.full(len(df), code))
+        # Info-bulle et popup (ou valeurs de ses champs) des centrales, joints aux points isolés des tuiles
+        plants.extend(row[2:] for row in layer_rows(layer, (templates or {}).get(layer['type'])))
+    
+    if not layers:
+        return None
+    with stage('clusters', rows=len(plants)) as metrics:
+        engine = ZoomClusters(np.concatenate(latitudes), np.concatenate(longitudes),
+                              np.concatenate(capacities), np.concatenate(codes))
+        metrics['clusters'] = sum(len(level['count']) for level in engine.levels.values())
+    return ClusterLayers(engine, layers, groups, plants, data_dir).add_to(m)
+
+def _iter_elements(element):
+    yield element
+    for child in element._children.values():
+        yield from _iter_elements(child)
+
+def _write_if_changed(path, build_payload):
+    """Écrit un fichier sauf s'il existe déjà (les noms contiennent l'empreinte du contenu).
+
+    build_payload n'est appelé (compression comprise) que si le fichier doit être écrit.
+    """
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(build_payload())
+
+def map_data_dir(output_path):
+    """Répertoire des fichiers de données d'une carte, relatif à celui de la page ('carte_data' pour 'carte.html')."""
+    return os.path.splitext(os.path.basename(output_path))[0] + '_data'
+
+def save_map(m, output_path):
+    """Enregistre la carte et, en mode 'split' ou 'clusters', les fichiers de données de ses couches.
+    
+    Chaque fichier de couche est accompagné de versions précompressées .gz (et .br si le module
+    brotli est installé) pour l'hébergement statique. Les fichiers de données d'anciennes versions,
+    ou d'un autre mode de rendu, sont supprimés de map_data_dir(output_path).
+    """
+    with stage('save', path=output_path) as metrics:
+        m.save(output_path)
+        metrics['bytes'] = os.path.getsize(output_path)
+    
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    data_dir = os.path.join(output_dir, map_data_dir(output_path))
+    tiles = [element for element in _iter_elements(m) if isinstance(element, ClusterLayers)]
+    for element in tiles:
+        with stage('save_tiles', path=element.tiles_dir):
+            element.write_tiles(output_dir)
+    if not tiles:
+        remove_tiles(data_dir)
+    
+    clusters = [element for element in _iter_elements(m) if isinstance(element, LazyPlantCluster)]
+    if clusters:
+        with stage('save_layers', layers=len(clusters)):
+            _save_layer_files(clusters, output_dir)
     else:
-        print("Erreur lors de la récupération des données hydrauliques")
+        _remove_layer_files(data_dir)
+
+def _save_layer_files(clusters, output_dir):
+    written = set()
+    for cluster in clusters:
+        path = os.path.join(output_dir, cluster.url)
+        if cluster.payload is None:
+            written.update({path, path + '.gz', path + '.br'})
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = cluster.payload
+        _write_if_changed(path, lambda: payload)
+        _write_if_changed(path + '.gz', lambda: gzip.compress(payload, compresslevel=9, mtime=0))
+        written.update({path, path + '.gz'})
+        if brotli is not None:
+            _write_if_changed(path + '.br', lambda: brotli.compress(payload, quality=BROTLI_QUALITY))
+            written.add(path + '.br')
+    
+    # Supprimer les fichiers de couches qui ne sont plus référencés
+    for data_dir in {os.path.dirname(path) for path in written}:
+        _remove_layer_files(data_dir, keep=written)
+
+def _remove_layer_files(data_dir, keep=()):
+    """Supprime les fichiers de couches 'split' '<couche>.<empreinte>.json[.gz|.br]' de data_dir, sauf keep."""
+    if not os.path.isdir(data_dir):
         return
+    for name in os.listdir(data_dir):
+        path = os.path.join(data_dir, name)
+        if path not in keep and re.search(r'\.[0-9a-f]{12}\.json(\.gz|\.br)?$', name):
+            os.remove(path)
+
+def map_layer_manifest(m):
+    """Renvoie les couches 'split' d'une carte, regroupées par type de centrale."""
+    manifest = {}
+    for element in _iter_elements(m):
+        if isinstance(element, LazyPlantCluster):
+            manifest.setdefault(element.plant_type, []).append(element.manifest())
+    return manifest
+
+def map_tiles_dirs(m):
+    """Renvoie les répertoires de tuiles 'clusters' d'une carte."""
+    return [element.tiles_dir for element in _iter_elements(m) if isinstance(element, ClusterLayers)]
+
+def _layer_files_exist(layers, output_dir):
+    return all(os.path.exists(os.path.join(output_dir, layer['url'])) for layer in layers)
+
+def _build_outputs_exist(state, output_path):
+    """Vérifie que la page et les fichiers de données de la construction précédente sont présents."""
+    if not os.path.exists(output_path):
+        return False
+    if state.get('options', {}).get('render') == 'clusters' and not state.get('tiles'):
+        return False
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    if not all(_layer_files_exist(layers, output_dir) for layers in state.get('layers', {}).values()):
+        return False
+    return all(os.path.isdir(os.path.join(output_dir, tiles_dir)) for tiles_dir in state.get('tiles', []))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Génère la carte interactive des centrales EDF.")
+    parser.add_argument('--base-url', default=API_BASE_URL,
+                        help="URL de base de l'API Opendatasoft (par exemple un serveur local de substitution)")
+    parser.add_argument('--export', action='store_true',
+                        help="lire les jeux de données via l'export JSONL plutôt que page par page")
+    parser.add_argument('--output', default='carte_complete.html', help="fichier HTML de la carte")
+    parser.add_argument('--render', choices=RENDER_MODES, default='fast',
+                        help="'fast' : marqueurs construits dans le navigateur à partir de données compactes ; "
+                             "'markers' : un folium.Marker par centrale ; "
+                             "'split' : page légère et fichiers de données par couche chargés à la demande ; "
+                             "'clusters' : regroupements précalculés par niveau de zoom, en tuiles statiques")
+    parser.add_argument('--popups', choices=POPUP_MODES, default='deferred',
+                        help="'deferred' : popups construites dans le navigateur à leur ouverture à partir de "
+                             "données compactes ; 'inline' : HTML complet de chaque popup dans les données")
+    parser.add_argument('--hide', action='append', choices=tuple(DATASETS), default=[],
+                        help="type de centrales masqué à l'ouverture de la carte (répétable)")
+    parser.add_argument('--force', action='store_true',
+                        help="régénérer la carte même si les données n'ont pas changé depuis la dernière construction")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="enregistrer les tables normalisées dans un instantané daté (nécessite pyarrow)")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR, help="répertoire des instantanés")
+    parser.add_argument('--snapshot-format', choices=('arrow', 'parquet'), default='arrow',
+                        help="format des instantanés : 'arrow' (projetable en mémoire) ou 'parquet' (compact)")
+    parser.add_argument('--from-snapshot', nargs='?', const='latest', metavar='CHEMIN',
+                        help="construire la carte depuis un instantané (le plus récent par défaut) sans appeler l'API")
+    parser.add_argument('--serve', action='store_true',
+                        help="servir la carte et les données en HTTP au lieu de générer un fichier")
+    parser.add_argument('--host', default='127.0.0.1', help="adresse d'écoute du serveur (--serve)")
+    parser.add_argument('--port', type=int, default=8000, help="port du serveur (--serve)")
+    parser.add_argument('--refresh-minutes', type=float, default=60,
+                        help="intervalle de rafraîchissement des données du serveur (--serve)")
+    parser.add_argument('--offline', action='store_true',
+                        help="construire la carte uniquement à partir du cache local, sans accès réseau")
+    parser.add_argument('--no-cache', action='store_true', help="désactiver le cache HTTP sur disque")
+    parser.add_argument('--cache-dir', default='.cache_edf', help="répertoire du cache HTTP")
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL / 3600,
+                        help="durée (en heures) avant revalidation d'une réponse en cache")
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help="taille maximale du cache en Mo")
+    parser.add_argument('--variants', metavar='FICHIER',
+                        help="construire en parallèle les cartes des variantes déclarées dans un fichier JSON "
+                             "(région, type, puissance minimale...) à partir d'un seul chargement des données")
+    parser.add_argument('--jobs', type=int, help="nombre de processus de rendu des variantes (par défaut : nombre de cœurs)")
+    parser.add_argument('--production', action='store_true',
+                        help="ajouter la production des centrales (cercles proportionnels et curseur de période), "
+                             "ingérée en flux et agrégée de façon incrémentale")
+    parser.add_argument('--production-config', metavar='FICHIER',
+                        help="fichier JSON décrivant le jeu de données de production (identifiant, champs, filières), "
+                             "obligatoire avec --production")
+    parser.add_argument('--production-interval', default='1D',
+                        help="intervalle de rééchantillonnage de la production, à pas fixe ('1h', '1D'...)")
+    parser.add_argument('--production-dir', default='production', help="répertoire des partitions de production")
+    parser.add_argument('--production-since', metavar='DATE',
+                        help="date de début de la première ingestion de la production")
+    parser.add_argument('--log-json', action='store_true',
+                        help="journaliser au format JSON (une ligne par message, mesures des étapes incluses)")
+    parser.add_argument('--verbose', action='store_true', help="afficher les messages de débogage et les mesures des étapes")
+    parser.add_argument('--metrics', metavar='FICHIER',
+                        help="enregistrer les mesures de chaque étape (durée, octets, lignes, mémoire) en JSON")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="mesurer le pic de mémoire allouée par étape avec tracemalloc (ralentit l'exécution)")
+    parser.add_argument('--profile', metavar='FICHIER',
+                        help="enregistrer un profil cProfile de l'exécution (lisible avec pstats ou snakeviz)")
+    args = parser.parse_args(argv)
+    if args.offline and args.no_cache:
+        parser.error("--offline nécessite le cache")
+    if args.production and not args.production_config:
+        parser.error("--production nécessite --production-config (identifiant et champs du jeu de données de production)")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(json_logs=args.log_json, verbose=args.verbose)
+    metrics = reset_metrics()
+    if args.trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
     
-    # Récupérer les données nucléaires
-    nuclear_data = get_nuclear_data()
-    if nuclear_data:
-        print(f"Nombre total de centrales nucléaires: {nuclear_data.get('total_count', 0)}")
+    try:
+        with stage('total'):
+            run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info("Profil enregistré dans '%s'", args.profile)
+        if args.metrics:
+            metrics.write(args.metrics)
+            logger.info("Mesures enregistrées dans '%s'", args.metrics)
+        if args.trace_memory:
+            tracemalloc.stop()
+
+def run(args):
+    """Exécute la construction (ou le serveur) de la carte selon les options de la ligne de commande."""
+    # Vérifier les variantes déclarées avant de charger les données
+    variants = None
+    if args.variants:
+        from variantes import load_variants
         
-        # Créer le DataFrame nucléaire
-        df_nuclear = create_nuclear_dataframe(nuclear_data)
-        if df_nuclear is None:
-            print("Erreur lors de la création du DataFrame nucléaire")
-            return
+        variants = load_variants(args.variants)
+    
+    cache = None
+    if not args.no_cache and not args.from_snapshot:
+        ttl = args.cache_ttl * 3600
+        if args.serve:
+            # Chaque rafraîchissement du serveur doit revalider les réponses en cache auprès de l'API
+            ttl = min(ttl, args.refresh_minutes * 60)
+        cache = HttpCache(
+            args.cache_dir,
+            ttl=ttl,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+            offline=args.offline
+        )
+    
+    if args.serve:
+        from serveur import serve
+        
+        def load():
+            if args.from_snapshot:
+                snapshot_path = None if args.from_snapshot == 'latest' else args.from_snapshot
+                return load_snapshot(snapshot_path, directory=args.snapshot_dir)
+            dataframes = load_all_dataframes(base_url=args.base_url, export=args.export, cache=cache)
+            if cache is not None:
+                cache.evict()
+            missing = [DATASETS[dataset]['label'] for dataset, df in dataframes.items() if df is None]
+            if missing:
+                raise RuntimeError(f"données indisponibles: {', '.join(missing)}")
+            return dataframes
+        
+        serve(load, host=args.host, port=args.port, refresh_interval=args.refresh_minutes * 60,
+              render_mode='clusters' if args.render == 'clusters' else 'split')
+        return
+    
+    if args.from_snapshot:
+        # Charger les tables normalisées depuis un instantané
+        snapshot_path = None if args.from_snapshot == 'latest' else args.from_snapshot
+        with stage('load_snapshot'):
+            dataframes = load_snapshot(snapshot_path, directory=args.snapshot_dir)
     else:
-        print("Erreur lors de la récupération des données nucléaires")
+        # Récupérer et normaliser les trois jeux de données en parallèle
+        dataframes = load_all_dataframes(base_url=args.base_url, export=args.export, cache=cache)
+        if cache is not None:
+            cache.evict()
+    
+    for dataset, df in dataframes.items():
+        label = DATASETS[dataset]['label']
+        if df is None:
+            logger.error("Erreur lors de la récupération des données %ss", label)
+            return
+        logger.info("Nombre total de centrales %ss: %d", label, len(df),
+                    extra={'fields': {'dataset': dataset, 'rows': len(df)}})
+    
+    if variants is not None:
+        from variantes import render_variants
+        
+        output_dir = os.path.dirname(os.path.abspath(args.output))
+        render_variants(dataframes, variants, output_dir, jobs=args.jobs)
         return
     
-    # Récupérer les données thermiques
-    flamme_data = get_flamme_data()
-    if flamme_data:
-        print(f"Nombre total de centrales thermiques: {flamme_data.get('total_count', 0)}")
+    df_hydro = dataframes['hydro']
+    df_nuclear = dataframes['nuclear']
+    df_flamme = dataframes['flamme']
+    
+    # Mettre à jour les agrégats de production (sauf depuis un instantané) et construire leurs images
+    production = None
+    production_watermark = None
+    if args.production:
+        from production import (PRODUCTION_MAX_FRAMES, ProductionStore, load_production_source, production_frames,
+                                update_production)
         
-        # Créer le DataFrame thermique
-        df_flamme = create_flamme_dataframe(flamme_data)
-        if df_flamme is None:
-            print("Erreur lors de la création du DataFrame thermique")
-            return
-    else:
-        print("Erreur lors de la récupération des données thermiques")
+        store = ProductionStore(args.production_dir, load_production_source(args.production_config),
+                                args.production_interval)
+        if not args.from_snapshot:
+            with create_session(pool_size=1) as session:
+                update_production(store, session, base_url=args.base_url, cache=cache, export=args.export,
+                                  since=args.production_since)
+        with stage('production_frames'):
+            production = production_frames(store.read(PRODUCTION_MAX_FRAMES), dataframes)
+        production_watermark = store.state['watermark']
+    
+    # Comparer les empreintes des données avec celles de la construction précédente
+    output_base = os.path.splitext(args.output)[0]
+    state_path = output_base + '.fingerprints.json'
+    previous_state = load_build_state(state_path) or {}
+    previous_fingerprints = previous_state.get('fingerprints', {})
+    options = {'render': args.render, 'popups': args.popups, 'hide': sorted(args.hide)}
+    if args.production:
+        options['production'] = args.production_interval
+    
+    fingerprints = {}
+    changes = {}
+    for dataset, df in dataframes.items():
+        with stage('fingerprint', dataset=dataset, rows=len(df)):
+            fingerprints[dataset] = fingerprint_dataframe(df, PLANT_KEYS[dataset])
+            changes[dataset] = diff_fingerprints(previous_fingerprints.get(dataset), fingerprints[dataset])
+    write_change_summary(output_base + '.changes.json', changes)
+    
+    if args.snapshot:
+        with stage('snapshot', format=args.snapshot_format):
+            snapshot_path = write_snapshot(dataframes, args.snapshot_dir, fmt=args.snapshot_format,
+                                           fingerprints=fingerprints)
+        logger.info("Instantané des données: %s", snapshot_path)
+    
+    changed = [dataset for dataset, change in changes.items() if change['changed']]
+    for dataset in changed:
+        change = changes[dataset]
+        logger.info("Centrales %ss modifiées: %d ajoutée(s), %d supprimée(s), %d modifiée(s)",
+                    DATASETS[dataset]['label'], len(change['added']), len(change['removed']), len(change['modified']),
+                    extra={'fields': {'dataset': dataset, 'added': len(change['added']),
+                                      'removed': len(change['removed']), 'modified': len(change['modified'])}})
+    
+    same_options = previous_state.get('options') == options
+    same_production = previous_state.get('production') == production_watermark
+    if (not changed and same_options and same_production and not args.force
+            and _build_outputs_exist(previous_state, args.output)):
+        logger.info("Aucune modification des données : '%s' est à jour.", args.output)
         return
     
-    print("\nCréation de la carte combinée...")
+    # En mode 'split', reprendre les couches des jeux de données inchangés
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    reuse_layers = {}
+    if args.render == 'split' and same_options and not args.force:
+        for dataset, layers in previous_state.get('layers', {}).items():
+            if dataset not in changed and _layer_files_exist(layers, output_dir):
+                reuse_layers[dataset] = layers
+    
+    logger.info("Création de la carte combinée...")
     
     # Créer la carte
-    m = create_combined_map(df_hydro, df_nuclear, df_flamme)
+    data_dir = map_data_dir(args.output)
+    with stage('map', render=args.render):
+        m = create_combined_map(df_hydro, df_nuclear, df_flamme, render_mode=args.render,
+                                data_dir=data_dir, hidden_types=args.hide, reuse_layers=reuse_layers,
+                                popups=args.popups, production=production)
     
-    # Sauvegarder la carte
-    m.save('carte_complete.html')
-    print("Carte créée ! Ouvrez le fichier 'carte_complete.html' dans votre navigateur pour voir la carte interactive.")
+    # Sauvegarder la carte et l'état de la construction
+    save_map(m, args.output)
+    save_build_state(state_path, {
+        'options': options,
+        'fingerprints': fingerprints,
+        'layers': map_layer_manifest(m),
+        'tiles': map_tiles_dirs(m),
+        'production': production_watermark,
+    })
+    logger.info("Carte créée ! Ouvrez le fichier '%s' dans votre navigateur pour voir la carte interactive.", args.output)
 
 if __name__ == "__main__":
     main()
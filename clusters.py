@@ -0,0 +1,298 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from jinja2 import Template
+
+# Rayon de regroupement en pixels et taille des tuiles en pixels
+CLUSTER_RADIUS = 60
+TILE_EXTENT = 256
+MIN_ZOOM = 0
+MAX_ZOOM = 14
+
+def project(latitudes, longitudes):
+    """Projette des coordonnées en Web Mercator normalisé ([0, 1] sur chaque axe)."""
+    x = np.asarray(longitudes, dtype=np.float64) / 360 + 0.5
+    sin = np.sin(np.radians(np.asarray(latitudes, dtype=np.float64)))
+    y = 0.5 - 0.25 * np.log((1 + sin) / (1 - sin)) / math.pi
+    return x, np.clip(y, 0.0, 1.0)
+
+def unproject(x, y):
+    longitudes = (x - 0.5) * 360
+    latitudes = np.degrees(2 * np.arctan(np.exp((0.5 - y) * 2 * math.pi)) - math.pi / 2)
+    return latitudes, longitudes
+
+class ZoomClusters:
+    """Regroupement des centrales précalculé pour chaque niveau de zoom, catégorie par catégorie.
+
+    Chaque niveau est calculé à partir du niveau plus détaillé : les points (ou groupes) d'une même
+    catégorie tombant dans la même cellule de CLUSTER_RADIUS pixels sont fusionnés en un groupe
+    placé au barycentre de ses centrales, avec leur nombre et leur puissance installée cumulée.
+    Au-delà de max_zoom, les centrales sont servies individuellement.
+
+    Un élément de niveau est une ligne [lon, lat, nombre, puissance (MW), couche, centrale],
+    où centrale est l'indice de la centrale pour un point isolé et -1 pour un groupe.
+    """
+
+    def __init__(self, latitudes, longitudes, capacities, layers, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM,
+                 radius=CLUSTER_RADIUS, extent=TILE_EXTENT):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        x, y = project(latitudes, longitudes)
+        n = len(x)
+        level = {
+            'x': x,
+            'y': y,
+            'count': np.ones(n, dtype=np.int64),
+            'capacity': np.nan_to_num(np.asarray(capacities, dtype=np.float64)),
+            'layer': np.asarray(layers, dtype=np.int64),
+            'member': np.arange(n, dtype=np.int64),
+        }
+        self.levels = {max_zoom + 1: self._sorted(level)}
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            level = self._cluster(level, radius / (extent * 2 ** zoom))
+            self.levels[zoom] = self._sorted(level)
+
+    @staticmethod
+    def _cluster(level, cell):
+        cells_per_axis = int(math.ceil(1 / cell)) + 1
+        key = (level['layer'] * cells_per_axis + (level['x'] / cell).astype(np.int64)) * cells_per_axis \
+            + (level['y'] / cell).astype(np.int64)
+        _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+
+        count = np.bincount(inverse, weights=level['count'])
+        single = count == 1
+        return {
+            'x': np.bincount(inverse, weights=level['x'] * level['count']) / count,
+            'y': np.bincount(inverse, weights=level['y'] * level['count']) / count,
+            'count': count.astype(np.int64),
+            'capacity': np.bincount(inverse, weights=level['capacity']),
+            'layer': level['layer'][first],
+            'member': np.where(single, level['member'][first], -1),
+        }
+
+    @staticmethod
+    def _sorted(level):
+        """Trie un niveau selon y pour accélérer les requêtes par emprise."""
+        order = np.argsort(level['y'], kind='stable')
+        return {name: values[order] for name, values in level.items()}
+
+    def level_for(self, zoom):
+        return self.levels[min(max(int(zoom), self.min_zoom), self.max_zoom + 1)]
+
+    def query(self, zoom, x0, y0, x1, y1):
+        """Indices des éléments du niveau de zoom dont la position projetée est dans [x0, x1] x [y0, y1]."""
+        level = self.level_for(zoom)
+        start, end = np.searchsorted(level['y'], [y0, y1], side='left')
+        idx = np.arange(start, end)
+        x = level['x'][idx]
+        return level, idx[(x >= x0) & (x <= x1)]
+
+    def tile(self, zoom, tile_x, tile_y):
+        """Éléments d'une tuile z/x/y (schéma XYZ de Leaflet)."""
+        size = 1 / 2 ** zoom
+        x0, y0 = tile_x * size, tile_y * size
+        level, idx = self.query(zoom, x0, y0, x0 + size, y0 + size)
+        # Les éléments sur une bordure n'appartiennent qu'à une seule tuile
+        idx = idx[(level['x'][idx] < x0 + size) & (level['y'][idx] < y0 + size)]
+        return self.rows(level, idx)
+
+    def rows(self, level, idx):
+        latitudes, longitudes = unproject(level['x'][idx], level['y'][idx])
+        return [
+            [round(lon, 5), round(lat, 5), count, round(capacity, 1), layer, member]
+            for lon, lat, count, capacity, layer, member in zip(
+                longitudes.tolist(), latitudes.tolist(), level['count'][idx].tolist(),
+                level['capacity'][idx].tolist(), level['layer'][idx].tolist(), level['member'][idx].tolist()
+            )
+        ]
+
+    def iter_tiles(self):
+        """Parcourt les tuiles non vides de chaque niveau : (zoom, x, y, éléments)."""
+        for zoom in range(self.min_zoom, self.max_zoom + 2):
+            level = self.levels[zoom]
+            tiles_per_axis = 2 ** zoom
+            tile_x = np.minimum((level['x'] * tiles_per_axis).astype(np.int64), tiles_per_axis - 1)
+            tile_y = np.minimum((level['y'] * tiles_per_axis).astype(np.int64), tiles_per_axis - 1)
+            order = np.lexsort((tile_y, tile_x))
+            keys = tile_x[order] * tiles_per_axis + tile_y[order]
+            bounds = np.flatnonzero(np.diff(keys)) + 1
+            for idx in np.split(order, bounds):
+                if len(idx):
+                    yield zoom, int(tile_x[idx[0]]), int(tile_y[idx[0]]), self.rows(level, idx)
+
+def tile_payload(rows, plants):
+    """Sérialise une tuile ; les points isolés sont complétés par les données de leur centrale."""
+    return json.dumps(
+        [row + plants[row[5]] if row[5] >= 0 else row[:5] for row in rows],
+        ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+
+def remove_tiles(data_dir, keep=None):
+    """Supprime les répertoires de tuiles 'clusters.<empreinte>' de data_dir, sauf keep."""
+    if not os.path.isdir(data_dir):
+        return
+    for name in os.listdir(data_dir):
+        path = os.path.join(data_dir, name)
+        if name.startswith('clusters.') and path != keep:
+            shutil.rmtree(path)
+
+class ClusterLayers(JSCSSMixin, MacroElement):
+    """Affiche les groupes précalculés (tuiles statiques ou API) visibles au zoom courant.
+
+    Les marqueurs des centrales isolées utilisent les fonctions de carte_complete.PlantMarkers.
+
+    À chaque déplacement de la carte, les tuiles visibles sont téléchargées (une seule fois chacune)
+    et leurs éléments répartis dans une couche par catégorie, rattachée au groupe de son type de
+    centrale pour que le contrôle des couches continue de fonctionner.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            (function () {
+                var map = {{ this._parent.get_name() }};
+                var groups = {
+                {%- for plant_type, group in this.groups.items() %}
+                    {{ plant_type|tojson }}: {{ group.get_name() }},
+                {%- endfor %}
+                };
+                var layers = {{ this.layers|tojson }};
+                var options = {{ this.options|tojson }};
+                var layerGroups = layers.map(function (layer) {
+                    return L.layerGroup().addTo(groups[layer.type]);
+                });
+                var icons = layers.map(function (layer) {
+                    return L.AwesomeMarkers.icon({
+                        markerColor: layer.style.color,
+                        iconColor: 'white',
+                        icon: layer.style.icon,
+                        prefix: layer.style.prefix,
+                        extraClasses: 'fa-rotate-0'
+                    });
+                });
+                var tiles = {};
+                var generation = 0;
+
+                function loadTile(z, x, y) {
+                    var url = options.url.replace('{z}', z).replace('{x}', x).replace('{y}', y);
+                    if (!(url in tiles)) {
+                        tiles[url] = fetch(url)
+                            .then(function (response) { return response.ok ? response.json() : []; })
+                            .catch(function () { return []; });
+                    }
+                    return tiles[url];
+                }
+
+                function createMarker(row, z) {
+                    var latlng = [row[1], row[0]];
+                    if (row[2] === 1) {
+                        var marker = L.marker(latlng, {icon: icons[row[4]]});
+                        marker.bindTooltip('<div>' + row[6] + '</div>', {sticky: true});
+                        bindPlantPopup(marker, plantPopupTemplates[layers[row[4]].type], row, 6);
+                        return marker;
+                    }
+                    var size = row[2] < 10 ? 'small' : (row[2] < 100 ? 'medium' : 'large');
+                    var cluster = L.marker(latlng, {icon: L.divIcon({
+                        html: '<div><span>' + row[2] + '</span></div>',
+                        className: 'marker-cluster marker-cluster-' + size,
+                        iconSize: L.point(40, 40)
+                    })});
+                    cluster.bindTooltip(row[2] + ' centrales - ' + row[3] + ' MW', {sticky: true});
+                    cluster.on('click', function () {
+                        map.setView(latlng, Math.min(z + 2, options.maxZoom + 1));
+                    });
+                    return cluster;
+                }
+
+                function tileRange(coordinate, n) {
+                    return Math.min(n - 1, Math.max(0, Math.floor(coordinate * n)));
+                }
+
+                function update() {
+                    var z = Math.max(options.minZoom, Math.min(options.maxZoom + 1, Math.round(map.getZoom())));
+                    var n = Math.pow(2, z);
+                    var bounds = map.getBounds();
+                    function tileY(lat) {
+                        var sin = Math.sin(lat * Math.PI / 180);
+                        return 0.5 - 0.25 * Math.log((1 + sin) / (1 - sin)) / Math.PI;
+                    }
+                    var x0 = tileRange(bounds.getWest() / 360 + 0.5, n);
+                    var x1 = tileRange(bounds.getEast() / 360 + 0.5, n);
+                    var y0 = tileRange(tileY(Math.min(bounds.getNorth(), 85)), n);
+                    var y1 = tileRange(tileY(Math.max(bounds.getSouth(), -85)), n);
+                    var requests = [];
+                    for (var x = x0; x <= x1; x++) {
+                        for (var y = y0; y <= y1; y++) {
+                            requests.push(loadTile(z, x, y));
+                        }
+                    }
+                    var current = ++generation;
+                    Promise.all(requests).then(function (results) {
+                        if (current !== generation) {
+                            return;
+                        }
+                        layerGroups.forEach(function (group) { group.clearLayers(); });
+                        results.forEach(function (rows) {
+                            rows.forEach(function (row) {
+                                layerGroups[row[4]].addLayer(createMarker(row, z));
+                            });
+                        });
+                    });
+                }
+
+                map.on('moveend', update);
+                update();
+            })();
+        {% endmacro %}
+        """
+    )
+
+    default_css = [
+        ("markerclustercss",
+         "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.css"),
+        ("markerclusterdefaultcss",
+         "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.Default.css"),
+    ]
+
+    def __init__(self, engine, layers, groups, plants, data_dir):
+        super().__init__()
+        self._name = "ClusterLayers"
+        self.engine = engine
+        self.layers = layers
+        self.groups = groups
+        self.plants = plants
+        # L'empreinte des données dans le chemin des tuiles autorise leur mise en cache longue durée
+        digest = hashlib.sha256()
+        for zoom, level in sorted(engine.levels.items()):
+            for values in level.values():
+                digest.update(values.tobytes())
+        digest.update(json.dumps([layers, plants], ensure_ascii=False).encode('utf-8'))
+        self.tiles_dir = f"{data_dir}/clusters.{digest.hexdigest()[:12]}"
+        self.options = {
+            'url': self.tiles_dir + '/{z}/{x}/{y}.json',
+            'minZoom': engine.min_zoom,
+            'maxZoom': engine.max_zoom,
+        }
+
+    def tile_payload(self, zoom, tile_x, tile_y):
+        return tile_payload(self.engine.tile(zoom, tile_x, tile_y), self.plants)
+
+    def write_tiles(self, output_dir):
+        """Écrit les tuiles statiques et supprime celles des versions précédentes."""
+        tiles_dir = os.path.join(output_dir, self.tiles_dir)
+        remove_tiles(os.path.dirname(tiles_dir), keep=tiles_dir)
+        if os.path.isdir(tiles_dir):
+            return
+
+        tmp_dir = tiles_dir + '.tmp'
+        for zoom, tile_x, tile_y, rows in self.engine.iter_tiles():
+            directory = os.path.join(tmp_dir, str(zoom), str(tile_x))
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"{tile_y}.json"), 'wb') as f:
+                f.write(tile_payload(rows, self.plants))
+        os.replace(tmp_dir, tiles_dir)
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# Colonnes identifiant une centrale (ou une tranche) dans chaque jeu de données normalisé
+PLANT_KEYS = {
+    'hydro': ['Centrale'],
+    'nuclear': ['Centrale'],
+    'flamme': ['Centrale', 'Tranche'],
+}
+
+def plant_ids(df, key_columns):
+    """Construit un identifiant stable par ligne à partir des colonnes clés.
+
+    Les lignes partageant la même clé (par exemple les réacteurs d'une même centrale nucléaire)
+    sont numérotées dans l'ordre de leur contenu, indépendamment de l'ordre renvoyé par l'API.
+    """
+    keys = df[key_columns[0]].astype(str)
+    for column in key_columns[1:]:
+        keys = keys + " - " + df[column].astype(str)
+
+    row_hashes = pd.util.hash_pandas_object(df, index=False)
+    order = pd.DataFrame({'key': keys.values, 'hash': row_hashes.values}).sort_values(['key', 'hash'])
+    rank = order.groupby('key', sort=False).cumcount().reindex(range(len(df))).values
+
+    ids = keys.where(rank == 0, keys + "#" + (rank + 1).astype(str))
+    return ids, row_hashes
+
+def fingerprint_dataframe(df, key_columns):
+    """Calcule l'empreinte d'un jeu de données normalisé : une empreinte par centrale et une globale."""
+    ids, row_hashes = plant_ids(df.reset_index(drop=True), key_columns)
+    plants = dict(zip(ids, (f"{value:016x}" for value in row_hashes)))
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([list(df.columns), [str(dtype) for dtype in df.dtypes]]).encode('utf-8'))
+    for plant_id in sorted(plants):
+        digest.update(f"{plant_id}\0{plants[plant_id]}\n".encode('utf-8'))
+    return {'digest': digest.hexdigest(), 'plants': plants}
+
+def diff_fingerprints(previous, current):
+    """Compare deux empreintes de jeu de données et liste les centrales ajoutées, supprimées et modifiées."""
+    old_plants = previous['plants'] if previous else {}
+    new_plants = current['plants']
+    return {
+        'changed': previous is None or previous['digest'] != current['digest'],
+        'added': sorted(new_plants.keys() - old_plants.keys()),
+        'removed': sorted(old_plants.keys() - new_plants.keys()),
+        'modified': sorted(plant_id for plant_id in new_plants.keys() & old_plants.keys()
+                           if new_plants[plant_id] != old_plants[plant_id]),
+    }
+
+def load_build_state(path):
+    """Charge l'état de la construction précédente (empreintes, options, couches), ou None."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_build_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def write_change_summary(path, changes):
+    """Écrit le résumé des modifications (centrales ajoutées, supprimées, modifiées) au format JSON."""
+    summary = {
+        'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'datasets': changes,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,277 @@
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+# Rayon moyen de la Terre en kilomètres
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Nombre moyen visé de points par cellule de la grille
+TARGET_POINTS_PER_CELL = 16
+
+# Colonne utilisée comme catégorie de chaque type de centrale
+CATEGORY_COLUMNS = {
+    'hydro': 'Catégorie',
+    'nuclear': 'Catégorie',
+    'flamme': 'Combustible',
+}
+
+def haversine_km(lat, lon, latitudes, longitudes):
+    """Distance orthodromique (km) entre un point et des tableaux de points."""
+    lat1 = math.radians(lat)
+    lat2 = np.radians(latitudes)
+    dlat = lat2 - lat1
+    dlon = np.radians(longitudes) - math.radians(lon)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _check_finite(**values):
+    """Rejette les paramètres NaN ou infinis, sur lesquels la recherche ne se terminerait pas."""
+    for name, value in values.items():
+        if not math.isfinite(value):
+            raise ValueError(f"{name} doit être un nombre fini: {value}")
+
+class PlantIndex:
+    """Index spatial en grille régulière sur les coordonnées des centrales.
+
+    Les points sont triés par cellule (ligne par ligne) : les cellules d'une même ligne de la
+    grille occupent une tranche contiguë des tableaux, si bien qu'une requête rectangulaire ne
+    lit qu'une tranche par ligne de cellules. Les requêtes renvoient les positions des centrales
+    dans `frame` (voir rows). Les longitudes ne franchissent pas l'antiméridien.
+    """
+
+    def __init__(self, latitudes, longitudes, types=None, categories=None, powers=None, cell_size=None, frame=None):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        valid = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        n = len(latitudes)
+        self.frame = frame
+
+        types = pd.Categorical(types if types is not None else np.full(n, None))
+        categories = pd.Categorical(categories if categories is not None else np.full(n, None))
+        powers = np.asarray(powers if powers is not None else np.full(n, np.nan), dtype=np.float32)
+        self.type_names = list(types.categories)
+        self.category_names = list(categories.categories)
+
+        lat = latitudes[valid]
+        lon = longitudes[valid]
+        if len(valid):
+            self.south, self.north = float(lat.min()), float(lat.max())
+            self.west, self.east = float(lon.min()), float(lon.max())
+        else:
+            self.south = self.north = self.west = self.east = 0.0
+
+        if cell_size is None:
+            area = max((self.north - self.south) * (self.east - self.west), 1e-6)
+            cell_size = math.sqrt(area * TARGET_POINTS_PER_CELL / max(len(valid), 1))
+        self.cell_size = max(cell_size, 1e-6)
+        self.n_rows = int((self.north - self.south) / self.cell_size) + 1
+        self.n_cols = int((self.east - self.west) / self.cell_size) + 1
+
+        cells = self._cell_rows(lat) * self.n_cols + self._cell_cols(lon)
+        order = np.argsort(cells, kind='stable')
+        self.offsets = np.searchsorted(cells[order], np.arange(self.n_rows * self.n_cols + 1))
+
+        # Tableaux triés par cellule
+        self.positions = valid[order]
+        self.latitudes = lat[order]
+        self.longitudes = lon[order]
+        self.types = types.codes[self.positions]
+        self.categories = categories.codes[self.positions]
+        self.powers = powers[self.positions]
+
+    @classmethod
+    def from_dataframes(cls, dataframes, cell_size=None):
+        """Construit l'index à partir des DataFrames normalisés {'hydro': ..., 'nuclear': ..., 'flamme': ...}."""
+        frames = []
+        for plant_type, df in dataframes.items():
+            frames.append(pd.DataFrame({
+                'Type de centrale': plant_type,
+                'Centrale': df['Centrale'].values,
+                'Catégorie': df[CATEGORY_COLUMNS[plant_type]].astype(object).values,
+                'Puissance (MW)': df['Puissance (MW)'].values,
+                'Latitude': df['Latitude'].values,
+                'Longitude': df['Longitude'].values,
+                'Position': np.arange(len(df)),
+            }))
+        frame = pd.concat(frames, ignore_index=True)
+        return cls(
+            frame['Latitude'], frame['Longitude'], frame['Type de centrale'], frame['Catégorie'],
+            frame['Puissance (MW)'], cell_size=cell_size, frame=frame
+        )
+
+    def _cell_rows(self, latitudes):
+        return np.clip(((latitudes - self.south) / self.cell_size).astype(np.int64), 0, self.n_rows - 1)
+
+    def _cell_cols(self, longitudes):
+        return np.clip(((longitudes - self.west) / self.cell_size).astype(np.int64), 0, self.n_cols - 1)
+
+    def _codes(self, names, values):
+        return np.array([names.index(value) for value in values if value in names], dtype=np.int64)
+
+    def _candidates(self, south, west, north, east):
+        """Indices (dans l'ordre de la grille) des points des cellules recouvrant le rectangle."""
+        if north < self.south or south > self.north or east < self.west or west > self.east:
+            return np.empty(0, dtype=np.int64)
+        r0, r1 = self._cell_rows(np.array([south, north]))
+        c0, c1 = self._cell_cols(np.array([west, east]))
+        rows = np.arange(r0, r1 + 1) * self.n_cols
+        starts = self.offsets[rows + c0]
+        ends = self.offsets[rows + c1 + 1]
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def _filter(self, idx, types=None, categories=None, min_power=None):
+        if types is not None:
+            idx = idx[np.isin(self.types[idx], self._codes(self.type_names, types))]
+        if categories is not None:
+            idx = idx[np.isin(self.categories[idx], self._codes(self.category_names, categories))]
+        if min_power is not None:
+            idx = idx[self.powers[idx] >= min_power]
+        return idx
+
+    def bbox(self, south, west, north, east, types=None, categories=None, min_power=None):
+        """Positions des centrales situées dans le rectangle donné, filtrées par type, catégorie et puissance."""
+        _check_finite(south=south, west=west, north=north, east=east)
+        idx = self._candidates(south, west, north, east)
+        lat = self.latitudes[idx]
+        lon = self.longitudes[idx]
+        idx = idx[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
+        return self.positions[self._filter(idx, types, categories, min_power)]
+
+    def _search_box(self, lat, lon, radius_km):
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6))
+        return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+    def radius(self, lat, lon, radius_km, types=None, categories=None, min_power=None):
+        """Positions et distances (km) des centrales à moins de radius_km du point, de la plus proche à la plus lointaine."""
+        _check_finite(lat=lat, lon=lon, radius_km=radius_km)
+        idx = self._filter(self._candidates(*self._search_box(lat, lon, radius_km)), types, categories, min_power)
+        distances = haversine_km(lat, lon, self.latitudes[idx], self.longitudes[idx])
+        inside = distances <= radius_km
+        idx, distances = idx[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return self.positions[idx[order]], distances[order]
+
+    def nearest(self, lat, lon, k=1, types=None, categories=None, min_power=None):
+        """Positions et distances (km) des k centrales les plus proches du point."""
+        if k < 1:
+            raise ValueError(f"k doit être un entier strictement positif: {k}")
+        _check_finite(lat=lat, lon=lon)
+        radius_km = self.cell_size * KM_PER_DEGREE
+        max_radius_km = math.pi * EARTH_RADIUS_KM
+        while True:
+            idx = self._filter(self._candidates(*self._search_box(lat, lon, radius_km)), types, categories, min_power)
+            if len(idx) >= k or radius_km >= max_radius_km:
+                distances = haversine_km(lat, lon, self.latitudes[idx], self.longitudes[idx])
+                if len(idx) > k:
+                    nearest = np.argpartition(distances, k - 1)[:k]
+                else:
+                    nearest = np.arange(len(idx))
+                nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+                # Les k points trouvés ne sont sûrs que s'ils sont dans le cercle entièrement couvert
+                if len(nearest) == 0 or distances[nearest[-1]] <= radius_km or radius_km >= max_radius_km:
+                    return self.positions[idx[nearest]], distances[nearest]
+                radius_km = float(distances[nearest[-1]])
+            else:
+                radius_km *= 2
+
+    def rows(self, positions, distances=None):
+        """Renvoie les lignes de `frame` correspondant à des positions (avec les distances si fournies)."""
+        rows = self.frame.iloc[positions]
+        if distances is not None:
+            rows = rows.assign(**{'Distance (km)': distances})
+        return rows
+
+def _synthetic_points(n, seed=0):
+    """Points répartis sur la France métropolitaine, en partie regroupés autour de foyers."""
+    rng = np.random.default_rng(seed)
+    clustered = n // 2
+    centers = rng.uniform([42.5, -4.5], [51.0, 8.0], size=(200, 2))
+    picks = centers[rng.integers(0, len(centers), clustered)]
+    latitudes = np.concatenate([rng.uniform(41.3, 51.1, n - clustered), picks[:, 0] + rng.normal(0, 0.15, clustered)])
+    longitudes = np.concatenate([rng.uniform(-5.2, 9.6, n - clustered), picks[:, 1] + rng.normal(0, 0.2, clustered)])
+    types = rng.choice(['hydro', 'nuclear', 'flamme'], n, p=[0.6, 0.1, 0.3])
+    categories = rng.choice(['Lac', "Fil de l'eau", 'Eclusée', 'REP 900', 'Gaz naturel'], n)
+    powers = rng.gamma(1.5, 150.0, n).astype(np.float32)
+    return latitudes, longitudes, types, categories, powers
+
+def _median_us(function, arguments):
+    timings = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+    return float(np.median(timings) * 1e6)
+
+def check(n=20_000, queries=200, seed=0):
+    """Compare les requêtes de l'index à une recherche exhaustive et vérifie le rejet des coordonnées invalides.
+
+    Lève AssertionError en cas d'écart.
+    """
+    latitudes, longitudes, types, categories, powers = _synthetic_points(n, seed)
+    latitudes[:10] = np.nan
+    index = PlantIndex(latitudes, longitudes, types, categories, powers)
+    valid = np.flatnonzero(~np.isnan(latitudes))
+
+    rng = np.random.default_rng(seed + 2)
+    for lat, lon in rng.uniform([41.0, -6.0], [52.0, 10.0], size=(queries, 2)):
+        south, west, north, east = lat - 0.2, lon - 0.3, lat + 0.2, lon + 0.3
+        inside = valid[(latitudes[valid] >= south) & (latitudes[valid] <= north)
+                       & (longitudes[valid] >= west) & (longitudes[valid] <= east)]
+        assert np.array_equal(np.sort(index.bbox(south, west, north, east)), inside)
+
+        distances = haversine_km(lat, lon, latitudes[valid], longitudes[valid])
+        positions, found = index.radius(lat, lon, 25.0)
+        assert np.array_equal(np.sort(positions), np.sort(valid[distances <= 25.0]))
+        positions, found = index.nearest(lat, lon, 5)
+        assert np.allclose(found, np.sort(distances)[:5])
+
+    for args in [(math.nan, 2.0), (46.0, math.inf), (-math.inf, math.nan)]:
+        for query in (lambda: index.nearest(*args), lambda: index.radius(*args, 10.0),
+                      lambda: index.bbox(*args, 47.0, 3.0)):
+            try:
+                query()
+            except ValueError:
+                continue
+            raise AssertionError(f"coordonnées invalides acceptées: {args}")
+
+def benchmark(n=1_000_000, queries=1000, seed=0):
+    """Mesure les temps médians (µs) de construction et de requête de l'index sur n points synthétiques."""
+    latitudes, longitudes, types, categories, powers = _synthetic_points(n, seed)
+    started = time.perf_counter()
+    index = PlantIndex(latitudes, longitudes, types, categories, powers)
+    build_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(seed + 1)
+    points = rng.uniform([42.5, -4.0], [50.5, 7.5], size=(queries, 2))
+    viewports = [(lat - 0.05, lon - 0.08, lat + 0.05, lon + 0.08) for lat, lon in points]
+    return {
+        'points': n,
+        'cell_size_deg': round(index.cell_size, 5),
+        'build_s': round(build_seconds, 3),
+        'bbox_us': round(_median_us(index.bbox, viewports), 1),
+        'bbox_filtered_us': round(_median_us(
+            lambda *box: index.bbox(*box, types=['hydro'], min_power=100), viewports), 1),
+        'radius_10km_us': round(_median_us(index.radius, [(lat, lon, 10.0) for lat, lon in points]), 1),
+        'nearest_1_us': round(_median_us(index.nearest, [(lat, lon, 1) for lat, lon in points]), 1),
+        'nearest_10_us': round(_median_us(index.nearest, [(lat, lon, 10) for lat, lon in points]), 1),
+        'nearest_nuclear_us': round(_median_us(
+            lambda lat, lon: index.nearest(lat, lon, types=['nuclear']), points.tolist()), 1),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de l'index spatial des centrales.")
+    parser.add_argument('--points', type=int, default=1_000_000, help="nombre de points synthétiques")
+    parser.add_argument('--queries', type=int, default=1000, help="nombre de requêtes par mesure")
+    args = parser.parse_args(argv)
+
+    check()
+    for name, value in benchmark(args.points, args.queries).items():
+        print(f"{name}: {value}")
+
+if __name__ == "__main__":
+    main()
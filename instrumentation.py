@@ -0,0 +1,146 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # module absent sous Windows : le pic de RSS n'est alors pas mesuré
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Nombre de mesures conservées (le serveur en produit à chaque rafraîchissement)
+MAX_STAGES = 10000
+
+class JsonFormatter(logging.Formatter):
+    """Formate chaque message en une ligne JSON, avec les champs passés via extra={'fields': {...}}."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging(json_logs=False, verbose=False, stream=None):
+    """Configure les journaux : texte simple par défaut, une ligne JSON par message avec json_logs.
+
+    Les mesures des étapes ne sont affichées qu'en JSON ou en mode verbeux.
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if json_logs else logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, handlers=[handler], force=True)
+    logger.setLevel(logging.DEBUG if json_logs or verbose else logging.WARNING)
+
+def _rss_mb():
+    """Mémoire résidente actuelle du processus (Linux), ou None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * _PAGE_SIZE / 1e6, 1)
+    except (OSError, IndexError, ValueError):
+        return None
+
+def _max_rss_mb():
+    """Pic de mémoire résidente du processus depuis son démarrage, ou None."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sous macOS et en Kio ailleurs
+    return round(max_rss * (1 if sys.platform == 'darwin' else 1024) / 1e6, 1)
+
+class Stage(dict):
+    """Mesures d'une étape ; les compteurs peuvent être incrémentés depuis plusieurs threads (add)."""
+
+    def __init__(self, name, **fields):
+        super().__init__(stage=name, **fields)
+        self._lock = threading.Lock()
+
+    def add(self, key, value):
+        with self._lock:
+            self[key] = self.get(key, 0) + value
+
+class Metrics:
+    """Collecte les mesures de chaque étape : durée, RSS, pic tracemalloc et champs propres à l'étape.
+
+    Le pic tracemalloc (si tracemalloc est actif) est remis à zéro au début de chaque étape de
+    premier niveau : pour une étape imbriquée ou concurrente, il couvre l'étape englobante.
+    """
+
+    def __init__(self, max_stages=MAX_STAGES):
+        self.started = time.perf_counter()
+        self.stages = deque(maxlen=max_stages)
+        self._lock = threading.Lock()
+        self._active = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        current = Stage(name, **fields)
+        tracing = tracemalloc.is_tracing()
+        with self._lock:
+            if tracing and self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+        started = time.perf_counter()
+        try:
+            yield current
+        except BaseException as e:
+            current['error'] = repr(e)
+            raise
+        finally:
+            current['start_s'] = round(started - self.started, 4)
+            current['seconds'] = round(time.perf_counter() - started, 4)
+            current['rss_mb'] = _rss_mb()
+            current['max_rss_mb'] = _max_rss_mb()
+            if tracing:
+                current['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+            with self._lock:
+                self._active -= 1
+                self.stages.append(current)
+            logger.debug("étape %s: %.3f s", name, current['seconds'], extra={'fields': dict(current)})
+
+    def summary(self):
+        """Durée cumulée et nombre d'occurrences de chaque étape."""
+        totals = {}
+        for current in self.stages:
+            total = totals.setdefault(current['stage'], {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] = round(total['seconds'] + current['seconds'], 4)
+        return totals
+
+    def write(self, path):
+        """Enregistre toutes les mesures dans un fichier JSON."""
+        report = {
+            'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'max_rss_mb': _max_rss_mb(),
+            'summary': self.summary(),
+            'stages': list(self.stages),
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+# Collecteur global utilisé par les points de mesure du code
+metrics = Metrics()
+
+def stage(name, **fields):
+    """Mesure une étape : `with stage('fetch', dataset='hydro') as s: ... s['rows'] = n`."""
+    return metrics.stage(name, **fields)
+
+def reset_metrics():
+    """Remplace le collecteur global par un nouveau et le renvoie."""
+    global metrics
+    metrics = Metrics()
+    return metrics
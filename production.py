@@ -0,0 +1,462 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import requests
+from branca.element import MacroElement
+from jinja2 import Template
+from pandas.tseries.frequencies import to_offset
+
+from carte_complete import (API_BASE_URL, COORDINATE_DECIMALS, REQUEST_TIMEOUT, _batched, _js_payload, _slugify,
+                            iter_export_records, iter_records)
+from empreintes import load_build_state, save_build_state
+from instrumentation import stage
+from snapshots import _require_pyarrow
+
+logger = logging.getLogger(__name__)
+
+# Description du jeu de données de production. L'identifiant du jeu de données et les noms de ses
+# champs n'ont pas de valeur par défaut : ils sont lus dans un fichier JSON (voir load_production_source)
+PRODUCTION_SOURCE = {
+    'id': None,
+    'fields': {
+        'time': None,
+        'plant': None,
+        # Facultatifs : filière (type de centrale) et tranche (une série par tranche d'une centrale)
+        'sector': None,
+        'unit': None,
+        'value': None,
+    },
+    # 'MW' : puissance moyenne sur le pas de temps ; 'MWh' : énergie produite pendant le pas de temps
+    'value_unit': 'MW',
+    'step': '1h',
+    'timezone': 'Europe/Paris',
+    # Filière du jeu de données -> type de centrale de la carte
+    'sectors': {
+        'Hydraulique': 'hydro',
+        'Nucléaire': 'nuclear',
+        'Thermique': 'flamme',
+        'Thermique à flamme': 'flamme',
+    },
+    # Nom de la centrale dans le jeu de données de production -> nom dans les tables des centrales
+    'aliases': {},
+}
+
+# Nombre d'enregistrements agrégés à la fois, et nombre de lots agrégés avant leur fusion
+PRODUCTION_CHUNK_SIZE = 100000
+MERGE_EVERY = 20
+
+# Nombre maximal de périodes envoyées au navigateur (les plus récentes)
+PRODUCTION_MAX_FRAMES = 366
+
+PRODUCTION_DIR = 'production'
+STATE_NAME = 'state.json'
+
+# Version du format des partitions, incrémentée si leurs colonnes changent
+PRODUCTION_FORMAT_VERSION = 2
+
+# Couleur des cercles de production de chaque type de centrale
+PRODUCTION_COLORS = {
+    'hydro': '#1f78b4',
+    'nuclear': '#e31a1c',
+    'flamme': '#ff7f00',
+}
+
+def load_production_source(path):
+    """Charge la description du jeu de données de production (fichier JSON complétant PRODUCTION_SOURCE).
+
+    Le fichier doit au moins donner l'identifiant du jeu de données ('id') et ses champs 'time',
+    'plant' et 'value'.
+    """
+    source = json.loads(json.dumps(PRODUCTION_SOURCE))
+    with open(path, encoding='utf-8') as f:
+        overrides = json.load(f)
+    unknown = set(overrides) - set(PRODUCTION_SOURCE)
+    if unknown:
+        raise ValueError(f"clé(s) inconnue(s) dans la source de production: {', '.join(sorted(unknown))}")
+    unknown = set(overrides.get('fields', {})) - set(PRODUCTION_SOURCE['fields'])
+    if unknown:
+        raise ValueError(f"champ(s) inconnu(s) dans la source de production: {', '.join(sorted(unknown))}")
+    fields = {**source['fields'], **overrides.pop('fields', {})}
+    source.update(overrides)
+    source['fields'] = fields
+
+    if not source['id']:
+        raise ValueError(f"identifiant du jeu de données de production ('id') non renseigné dans {path}")
+    missing = [name for name in ('time', 'plant', 'value') if not source['fields'].get(name)]
+    if missing:
+        raise ValueError(f"champ(s) obligatoire(s) non renseigné(s) dans {path}: {', '.join(missing)}")
+    if source['value_unit'] not in ('MW', 'MWh'):
+        raise ValueError(f"unité non prise en charge: {source['value_unit']!r} ('MW' ou 'MWh')")
+    interval_hours(source['step'])
+    return source
+
+def interval_hours(interval):
+    """Durée en heures d'un intervalle de rééchantillonnage à pas fixe ('30min', '1h', '1D'...)."""
+    try:
+        return to_offset(interval).nanos / 3.6e12
+    except ValueError:
+        raise ValueError(f"intervalle non pris en charge: {interval!r} (pas fixe attendu, par exemple '1h' ou '1D')")
+
+def _map_unique(series, function):
+    """Applique une fonction aux valeurs distinctes d'une colonne seulement."""
+    codes, uniques = pd.factorize(series)
+    mapped = np.array([function(value) for value in uniques] + [None], dtype=object)
+    return pd.Series(mapped[codes], index=series.index)
+
+# Colonnes identifiant une ligne d'agrégats
+AGGREGATE_KEYS = ['type', 'key', 'series', 'period']
+
+def aggregate_chunk(records, source, interval):
+    """Agrège un lot d'enregistrements par centrale et par période.
+
+    Renvoie (agrégats, dernier horodatage UTC du lot). Les agrégats contiennent, pour chaque série
+    ('series' : nom de la centrale et tranche dans le jeu de données) rattachée à une centrale ('type',
+    'key') et pour chaque période en heure locale, l'énergie produite (MWh) et la durée couverte par
+    ses mesures (heures) : ils s'additionnent d'un lot à l'autre (voir merge_aggregates).
+    """
+    fields = source['fields']
+    raw = pd.DataFrame.from_records(records, columns=[field for field in fields.values() if field])
+
+    step_hours = interval_hours(source['step'])
+    times = pd.to_datetime(raw[fields['time']], utc=True, errors='coerce', format='ISO8601')
+    values = pd.to_numeric(raw[fields['value']], errors='coerce').astype('float64')
+    if source['value_unit'] == 'MW':
+        values = values * step_hours
+
+    aliases = {_slugify(name): _slugify(plant) for name, plant in source['aliases'].items()}
+    keys = _map_unique(raw[fields['plant']], lambda name: aliases.get(_slugify(name), _slugify(name)))
+    series = _map_unique(raw[fields['plant']], _slugify)
+    if fields.get('unit'):
+        series = series + '/' + _map_unique(raw[fields['unit']], _slugify).fillna('')
+    if fields.get('sector'):
+        sectors = {_slugify(sector): plant_type for sector, plant_type in source['sectors'].items()}
+        types = _map_unique(raw[fields['sector']], lambda sector: sectors.get(_slugify(sector), '')).fillna('')
+    else:
+        types = pd.Series('', index=raw.index)
+
+    frame = pd.DataFrame({
+        'type': types,
+        'key': keys,
+        'series': series,
+        'period': times.dt.tz_convert(source['timezone']).dt.tz_localize(None).dt.floor(interval),
+        'energy': values,
+        'hours': step_hours,
+    }).dropna(subset=['type', 'key', 'series', 'period', 'energy'])
+    aggregates = frame.groupby(AGGREGATE_KEYS, sort=False).agg(
+        energy=('energy', 'sum'), hours=('hours', 'sum')
+    ).reset_index()
+    return aggregates, times.max()
+
+def merge_aggregates(parts):
+    """Fusionne des agrégats partiels (énergie et durée couverte additionnées)."""
+    if not parts:
+        return pd.DataFrame({'type': [], 'key': [], 'series': [], 'period': pd.to_datetime([]),
+                             'energy': [], 'hours': []})
+    if len(parts) == 1:
+        return parts[0]
+    return pd.concat(parts, ignore_index=True).groupby(AGGREGATE_KEYS, sort=False).agg(
+        energy=('energy', 'sum'), hours=('hours', 'sum')
+    ).reset_index()
+
+def aggregate_records(records, source, interval, chunk_size=PRODUCTION_CHUNK_SIZE):
+    """Rééchantillonne un flux d'enregistrements de production, lot par lot.
+
+    La mémoire de travail dépend de chunk_size et du nombre de couples (centrale, période), jamais
+    de la longueur du flux : les agrégats partiels sont fusionnés tous les MERGE_EVERY lots.
+    Renvoie (agrégats, dernier horodatage UTC ou None, nombre d'enregistrements lus).
+    """
+    parts = []
+    watermark = None
+    rows = 0
+    for batch in _batched(records, chunk_size):
+        aggregates, last_time = aggregate_chunk(batch, source, interval)
+        parts.append(aggregates)
+        rows += len(batch)
+        if pd.notna(last_time) and (watermark is None or last_time > watermark):
+            watermark = last_time
+        if len(parts) >= MERGE_EVERY:
+            parts = [merge_aggregates(parts)]
+    return merge_aggregates(parts), watermark, rows
+
+class ProductionStore:
+    """Agrégats de production enregistrés en partitions mensuelles Parquet, avec leur filigrane.
+
+    Le filigrane est le dernier horodatage ingéré. Une mise à jour ne relit que les enregistrements
+    à partir du début du mois de la période qui le contient (elle peut être incomplète) et ne
+    réécrit que les partitions de ces mois ; les partitions antérieures ne sont plus modifiées.
+    Chaque source et intervalle de rééchantillonnage a son propre répertoire.
+    """
+
+    def __init__(self, directory, source, interval):
+        interval_hours(interval)
+        self.source = source
+        self.interval = interval
+        self.path = os.path.join(directory, _slugify(source['id']), _slugify(interval))
+        self.state_path = os.path.join(self.path, STATE_NAME)
+        self.state = load_build_state(self.state_path)
+        if not self.state or self.state.get('format_version') != PRODUCTION_FORMAT_VERSION:
+            # Partitions absentes ou d'un ancien format : tout réingérer
+            self.state = {'format_version': PRODUCTION_FORMAT_VERSION, 'watermark': None, 'partitions': {}}
+
+    @property
+    def watermark(self):
+        return pd.Timestamp(self.state['watermark']) if self.state['watermark'] else None
+
+    def resume_from(self):
+        """Début (heure locale) du mois de la dernière période ingérée, ou None avant la première ingestion."""
+        if self.watermark is None:
+            return None
+        last_period = self.watermark.tz_convert(self.source['timezone']).tz_localize(None).floor(self.interval)
+        return last_period.to_period('M').to_timestamp()
+
+    def write(self, aggregates, watermark):
+        """Remplace les partitions des mois présents dans les agrégats et avance le filigrane."""
+        _require_pyarrow()
+        os.makedirs(self.path, exist_ok=True)
+        months = aggregates['period'].dt.strftime('%Y-%m')
+        for month, partition in aggregates.groupby(months, sort=True):
+            path = os.path.join(self.path, f"{month}.parquet")
+            partition = partition.sort_values(['period', 'type', 'key', 'series'], ignore_index=True)
+            partition.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+            self.state['partitions'][month] = len(partition)
+
+        if watermark is not None and (self.watermark is None or watermark > self.watermark):
+            self.state['watermark'] = watermark.isoformat()
+        save_build_state(self.state_path, self.state)
+        return sorted(set(months))
+
+    def read(self, max_periods=None):
+        """Lit les agrégats, en se limitant aux partitions des max_periods dernières périodes."""
+        _require_pyarrow()
+        partitions = []
+        periods = set()
+        for month in sorted(self.state['partitions'], reverse=True):
+            partition = pd.read_parquet(os.path.join(self.path, f"{month}.parquet"))
+            partitions.append(partition)
+            periods.update(partition['period'].unique())
+            if max_periods is not None and len(periods) >= max_periods:
+                break
+        return merge_aggregates(partitions[::-1])
+
+def _where_since(source, start):
+    return f"{source['fields']['time']} >= date'{start.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%SZ')}'"
+
+def update_production(store, session, base_url=API_BASE_URL, timeout=REQUEST_TIMEOUT, cache=None, export=False,
+                      since=None, chunk_size=PRODUCTION_CHUNK_SIZE):
+    """Ingère en flux les enregistrements postérieurs au filigrane et met à jour les partitions concernées.
+
+    since (date, en heure locale si sans fuseau) borne la première ingestion. Le jeu de données n'est
+    lu que par lots et n'est jamais chargé en entier ; les partitions ne sont écrites qu'une fois le
+    flux entièrement lu. Renvoie la liste des mois réécrits, ou None en cas d'erreur de l'API.
+    """
+    source = store.source
+    timezone = source['timezone']
+    resume = store.resume_from()
+    start = resume.tz_localize(timezone) if resume is not None else None
+    if since is not None:
+        since = pd.Timestamp(since)
+        since = since.tz_localize(timezone) if since.tz is None else since
+        start = since if start is None else max(start, since)
+
+    params = {'select': ','.join(field for field in source['fields'].values() if field)}
+    if start is not None:
+        params['where'] = _where_since(source, start)
+
+    try:
+        with stage('production_fetch', dataset=source['id'], interval=store.interval) as metrics:
+            if export:
+                records = iter_export_records(source['id'], session, base_url, timeout, cache, metrics, params)
+            else:
+                records = iter_records(source['id'], session, base_url, timeout, cache=cache, metrics=metrics,
+                                       params=params)
+            aggregates, watermark, rows = aggregate_records(records, source, store.interval, chunk_size)
+            metrics['rows'] = rows
+            metrics['aggregates'] = len(aggregates)
+    except requests.exceptions.RequestException as e:
+        logger.error("Erreur lors de la requête API de production: %s", e,
+                     extra={'fields': {'dataset': source['id']}})
+        return None
+
+    # Les périodes antérieures au mois repris sont déjà complètes dans leurs partitions
+    if resume is not None:
+        aggregates = aggregates[aggregates['period'] >= resume]
+    if aggregates.empty:
+        return []
+    with stage('production_partitions', rows=len(aggregates)) as metrics:
+        months = store.write(aggregates, watermark)
+        metrics['partitions'] = len(months)
+    logger.info("Production: %d enregistrement(s) lu(s), %d partition(s) mise(s) à jour, données jusqu'au %s",
+                rows, len(months), store.state['watermark'],
+                extra={'fields': {'rows': rows, 'partitions': months, 'watermark': store.state['watermark']}})
+    return months
+
+def production_sites(dataframes):
+    """Regroupe les centrales des tables normalisées par type et par nom (position moyenne, puissance cumulée)."""
+    frames = []
+    for plant_type, df in dataframes.items():
+        df = df[df['Latitude'].notna() & df['Longitude'].notna()]
+        frames.append(pd.DataFrame({
+            'type': plant_type,
+            'key': _map_unique(df['Centrale'].astype(object), _slugify),
+            'name': df['Centrale'].astype(object),
+            'lat': df['Latitude'].astype('float64'),
+            'lon': df['Longitude'].astype('float64'),
+            'capacity': df['Puissance (MW)'].astype('float64'),
+        }))
+    sites = pd.concat(frames, ignore_index=True).dropna(subset=['key'])
+    return sites.groupby(['type', 'key'], sort=False).agg(
+        name=('name', 'first'), lat=('lat', 'mean'), lon=('lon', 'mean'), capacity=('capacity', 'sum')
+    ).reset_index()
+
+def match_sites(aggregates, sites):
+    """Associe chaque ligne des agrégats à une centrale de sites (indice, ou -1).
+
+    Sans filière, une série n'est associée que si son nom désigne une seule centrale.
+    """
+    pairs = aggregates[['type', 'key']].drop_duplicates()
+    by_type = {(plant_type, key): i for i, (plant_type, key) in enumerate(zip(sites['type'], sites['key']))}
+    counts = sites['key'].value_counts()
+    by_key = {key: i for i, key in enumerate(sites['key']) if counts[key] == 1}
+    pairs['site'] = [
+        by_type.get((plant_type, key), -1) if plant_type else by_key.get(key, -1)
+        for plant_type, key in zip(pairs['type'], pairs['key'])
+    ]
+
+    unmatched = pairs.loc[pairs['site'] < 0, 'key']
+    if len(unmatched):
+        logger.warning("Production: %d série(s) sans centrale correspondante (%s)", len(unmatched),
+                       ', '.join(sorted(unmatched)[:10]), extra={'fields': {'unmatched': sorted(unmatched)}})
+    return aggregates.merge(pairs, on=['type', 'key'], how='left')['site'].to_numpy()
+
+def production_frames(aggregates, dataframes, max_frames=PRODUCTION_MAX_FRAMES):
+    """Construit les images de production envoyées au navigateur, ou None sans données.
+
+    Chaque image donne la puissance moyenne (MW) de chaque centrale sur une période : celle de chacune
+    de ses séries est calculée sur la durée effectivement mesurée, si bien qu'une période en cours ou
+    lacunaire n'est pas sous-estimée, puis les séries d'une même centrale sont additionnées. Seules les
+    max_frames dernières périodes et les centrales ayant produit sur l'une d'elles sont conservées.
+    """
+    if aggregates.empty:
+        return None
+    sites = production_sites(dataframes)
+    aggregates = aggregates.assign(site=match_sites(aggregates, sites))
+    aggregates = aggregates[aggregates['site'] >= 0]
+    if aggregates.empty:
+        return None
+
+    periods = np.sort(aggregates['period'].unique())[-max_frames:]
+    aggregates = aggregates[aggregates['period'] >= periods[0]]
+    power = (aggregates['energy'] / aggregates['hours']).groupby([aggregates['period'], aggregates['site']]).sum()
+
+    matrix = np.full((len(periods), len(sites)), np.nan)
+    matrix[np.searchsorted(periods, power.index.get_level_values('period')),
+           power.index.get_level_values('site')] = power.to_numpy()
+    used = ~np.isnan(matrix).all(axis=0)
+    matrix = matrix[:, used]
+    sites = sites[used]
+
+    periods = pd.DatetimeIndex(periods)
+    daily = ((periods.hour == 0) & (periods.minute == 0)).all()
+    return {
+        'periods': periods.strftime('%d/%m/%Y' if daily else '%d/%m/%Y %H:%M').tolist(),
+        'sites': [list(site) for site in zip(
+            sites['lat'].round(COORDINATE_DECIMALS).tolist(), sites['lon'].round(COORDINATE_DECIMALS).tolist(),
+            sites['name'].tolist(), sites['type'].tolist(), sites['capacity'].round(1).tolist()
+        )],
+        'frames': np.where(np.isnan(matrix), None, matrix.round(1)).tolist(),
+        'max': round(float(np.nanmax(matrix)), 1),
+    }
+
+class ProductionLayer(MacroElement):
+    """Cercles proportionnels à la production de chaque centrale, avec un curseur de période.
+
+    Les cercles sont rattachés au groupe de leur type de centrale : le contrôle des couches les masque
+    avec les marqueurs. Seules les images précalculées (voir production_frames) sont envoyées.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            (function () {
+                var map = {{ this._parent.get_name() }};
+                var groups = {
+                {%- for plant_type, group in this.groups.items() %}
+                    {{ plant_type|tojson }}: {{ group.get_name() }},
+                {%- endfor %}
+                };
+                var data = {{ this.payload_json }};
+                var colors = {{ this.colors|tojson }};
+                var maxRadius = {{ this.max_radius|tojson }};
+                var frame = data.frames.length - 1;
+                var layers = {};
+                var circles = data.sites.map(function (site, i) {
+                    if (!(site[3] in layers)) {
+                        layers[site[3]] = L.layerGroup().addTo(groups[site[3]]);
+                    }
+                    var circle = L.circleMarker([site[0], site[1]], {
+                        radius: 0, color: colors[site[3]], weight: 1, fillOpacity: 0.45
+                    });
+                    circle.bindTooltip(function () {
+                        var value = data.frames[frame][i];
+                        var text = '<b>' + site[2] + '</b><br>' + data.periods[frame] + ' : ';
+                        if (value === null) {
+                            return text + 'non renseigné';
+                        }
+                        text += value + ' MW';
+                        if (site[4]) {
+                            text += ' (' + Math.round(100 * value / site[4]) + ' % de ' + site[4] + ' MW)';
+                        }
+                        return text;
+                    }, {sticky: true});
+                    layers[site[3]].addLayer(circle);
+                    return circle;
+                });
+
+                var label = L.DomUtil.create('span');
+                function show(index) {
+                    frame = index;
+                    label.textContent = data.periods[frame];
+                    var values = data.frames[frame];
+                    for (var i = 0; i < circles.length; i++) {
+                        var value = values[i];
+                        var visible = value !== null && value > 0;
+                        circles[i].setRadius(visible ? maxRadius * Math.sqrt(value / data.max) : 0);
+                        circles[i].setStyle({opacity: visible ? 1 : 0, fillOpacity: visible ? 0.45 : 0});
+                    }
+                }
+
+                var control = L.control({position: 'bottomright'});
+                control.onAdd = function () {
+                    var div = L.DomUtil.create('div');
+                    div.style.cssText = 'background: white; padding: 6px 10px; border-radius: 4px; ' +
+                                        'box-shadow: 0 2px 4px rgba(0,0,0,0.2);';
+                    div.innerHTML = '<strong>Production moyenne</strong> ';
+                    div.appendChild(label);
+                    var slider = L.DomUtil.create('input', '', div);
+                    slider.type = 'range';
+                    slider.min = 0;
+                    slider.max = data.frames.length - 1;
+                    slider.value = frame;
+                    slider.style.cssText = 'display: block; width: 260px;';
+                    slider.addEventListener('input', function () { show(+slider.value); });
+                    L.DomEvent.disableClickPropagation(div);
+                    L.DomEvent.disableScrollPropagation(div);
+                    return div;
+                };
+                control.addTo(map);
+                show(frame);
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, payload, groups, max_radius=30):
+        super().__init__()
+        self._name = "ProductionLayer"
+        self.payload_json = _js_payload(payload)
+        self.groups = groups
+        self.colors = PRODUCTION_COLORS
+        self.max_radius = max_radius
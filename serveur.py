@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from email.utils import formatdate
+from urllib.parse import parse_qs, urlsplit
+
+from carte_complete import COORDINATE_DECIMALS, LazyPlantCluster, _iter_elements, create_combined_map
+from clusters import ClusterLayers
+from empreintes import PLANT_KEYS, fingerprint_dataframe
+from index_spatial import PlantIndex
+from instrumentation import stage
+
+# Ressource servie : corps brut et précompressé, type MIME, ETag et politique de cache
+Resource = namedtuple('Resource', 'body gzip_body content_type etag cache_control')
+
+# Les fichiers de couches ont une empreinte dans leur nom : ils ne changent jamais
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+KEEP_ALIVE_TIMEOUT = 15
+DEFAULT_REFRESH_INTERVAL = 3600
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 503: 'Service Unavailable'}
+
+def _resource(body, content_type, cache_control=REVALIDATE_CACHE):
+    etag = '"%s"' % hashlib.sha256(body).hexdigest()[:20]
+    return Resource(body, gzip.compress(body, compresslevel=6, mtime=0), content_type, etag, cache_control)
+
+def _records_json(df, **kwargs):
+    """Sérialise des lignes en JSON sans le bruit des colonnes float32 (131.8000030518 → 131.8)."""
+    return df.to_json(orient='records', force_ascii=False, double_precision=COORDINATE_DECIMALS,
+                      **kwargs).encode('utf-8')
+
+def _dataset_digests(dataframes):
+    return {dataset: fingerprint_dataframe(df, PLANT_KEYS[dataset])['digest'] for dataset, df in dataframes.items()}
+
+class MapState:
+    """Version immuable des données servies : page de la carte, fichiers de couches et API JSON.
+
+    Une nouvelle version est construite à part puis substituée d'un bloc à la précédente : les
+    requêtes en cours continuent d'utiliser la version qu'elles ont lue.
+    """
+
+    def __init__(self, dataframes, digests=None, render_mode='split'):
+        self.loaded_at = datetime.now(timezone.utc)
+        self.digests = digests
+        self.rows = {dataset: len(df) for dataset, df in dataframes.items()}
+        self.resources = {}
+        self.clusters = None
+
+        m = create_combined_map(dataframes['hydro'], dataframes['nuclear'], dataframes['flamme'],
+                                render_mode=render_mode, data_dir='layers')
+        html = m.get_root().render().encode('utf-8')
+        self.resources['/'] = _resource(html, 'text/html; charset=utf-8')
+
+        for element in _iter_elements(m):
+            if isinstance(element, LazyPlantCluster):
+                self.resources['/' + element.url] = _resource(
+                    element.payload, 'application/json', IMMUTABLE_CACHE
+                )
+            elif isinstance(element, ClusterLayers):
+                self.clusters = element
+
+        self.index = PlantIndex.from_dataframes(dataframes)
+
+        for dataset, df in dataframes.items():
+            body = _records_json(df, date_format='iso')
+            self.resources[f'/api/{dataset}.json'] = _resource(body, 'application/json')
+
+        self.version = hashlib.sha256(
+            ''.join(resource.etag for resource in self.resources.values()).encode('ascii')
+        ).hexdigest()[:12]
+
+    def cluster_tile(self, path):
+        """Tuile de regroupements '/layers/clusters.<empreinte>/z/x/y.json', calculée à la demande."""
+        if self.clusters is None:
+            return None
+        match = re.fullmatch(re.escape('/' + self.clusters.tiles_dir) + r'/(\d+)/(\d+)/(\d+)\.json', path)
+        if match is None:
+            return None
+        zoom, tile_x, tile_y = (int(value) for value in match.groups())
+        if zoom > 30 or tile_x >= 2 ** zoom or tile_y >= 2 ** zoom:
+            return None
+        return _resource(self.clusters.tile_payload(zoom, tile_x, tile_y), 'application/json', IMMUTABLE_CACHE)
+
+class MapServer:
+    """Serveur HTTP asynchrone de la carte, avec rafraîchissement périodique des données en arrière-plan.
+
+    load_dataframes est appelée dans un thread et doit renvoyer un dictionnaire
+    {'hydro': DataFrame, 'nuclear': DataFrame, 'flamme': DataFrame}.
+    """
+
+    def __init__(self, load_dataframes, refresh_interval=DEFAULT_REFRESH_INTERVAL, render_mode='split'):
+        self.load_dataframes = load_dataframes
+        self.refresh_interval = refresh_interval
+        self.render_mode = render_mode
+        self.state = None
+        self.requests_served = 0
+
+    async def refresh(self):
+        """Recharge les données et construit une nouvelle version sans bloquer les requêtes."""
+        started = time.perf_counter()
+        dataframes = await asyncio.to_thread(self.load_dataframes)
+        digests = await asyncio.to_thread(_dataset_digests, dataframes)
+        if self.state is not None and self.state.digests == digests:
+            logger.info("Données inchangées, version conservée")
+            return
+
+        state = await asyncio.to_thread(self._build_state, dataframes, digests)
+        self.state = state
+        logger.info("Données chargées (version %s) en %.2f s", state.version, time.perf_counter() - started,
+                    extra={'fields': {'version': state.version, 'rows': state.rows}})
+
+    def _build_state(self, dataframes, digests):
+        with stage('build_state', render=self.render_mode):
+            return MapState(dataframes, digests, self.render_mode)
+
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Conserver la version courante si le rafraîchissement échoue
+                logger.exception("Erreur lors du rafraîchissement des données: %s", e)
+
+    def respond(self, method, target, headers):
+        """Renvoie (statut, en-têtes, corps) pour une requête."""
+        if method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, b''
+
+        state = self.state
+        if state is None:
+            return 503, {'Retry-After': '5'}, b''
+
+        url = urlsplit(target)
+        path = url.path
+        if path == '/api/plants':
+            return self.query_plants(state, parse_qs(url.query), headers)
+
+        if path == '/api/status':
+            body = json.dumps({
+                'version': state.version,
+                'loaded_at': state.loaded_at.isoformat(timespec='seconds'),
+                'rows': state.rows,
+                'requests_served': self.requests_served,
+            }).encode('utf-8')
+            return 200, {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}, body
+
+        resource = state.resources.get(path) or state.cluster_tile(path)
+        if resource is None:
+            return 404, {'Content-Type': 'text/plain; charset=utf-8'}, b'Not Found'
+
+        response_headers = {
+            'Content-Type': resource.content_type,
+            'ETag': resource.etag,
+            'Cache-Control': resource.cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if headers.get('if-none-match') == resource.etag:
+            return 304, response_headers, b''
+
+        if 'gzip' in headers.get('accept-encoding', ''):
+            response_headers['Content-Encoding'] = 'gzip'
+            return 200, response_headers, resource.gzip_body
+        return 200, response_headers, resource.body
+
+    def query_plants(self, state, query, headers):
+        """Centrales d'une emprise (bbox=sud,ouest,nord,est) ou les plus proches d'un point (near=lat,lon&k=)."""
+        try:
+            filters = {
+                'types': query['type'][0].split(',') if 'type' in query else None,
+                'categories': query['category'] if 'category' in query else None,
+                'min_power': float(query['min_power'][0]) if 'min_power' in query else None,
+            }
+            if 'bbox' in query:
+                south, west, north, east = (float(value) for value in query['bbox'][0].split(','))
+                rows = state.index.rows(state.index.bbox(south, west, north, east, **filters))
+            elif 'near' in query:
+                lat, lon = (float(value) for value in query['near'][0].split(','))
+                k = query.get('k', ['1'])[0]
+                if not k.strip().isdigit():
+                    raise ValueError(f"k doit être un entier strictement positif: {k!r}")
+                k = int(k)
+                rows = state.index.rows(*state.index.nearest(lat, lon, k, **filters))
+            else:
+                raise ValueError("paramètre bbox ou near requis")
+        except (ValueError, KeyError) as e:
+            return 400, {'Content-Type': 'text/plain; charset=utf-8'}, str(e).encode('utf-8')
+        
+        resource = _resource(_records_json(rows), 'application/json')
+        response_headers = {'Content-Type': resource.content_type, 'ETag': resource.etag,
+                            'Cache-Control': resource.cache_control}
+        if headers.get('if-none-match') == resource.etag:
+            return 304, response_headers, b''
+        return 200, response_headers, resource.body
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                if not request_line:
+                    break
+
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                if len(parts) != 3:
+                    status, response_headers, body = 400, {}, b''
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    status, response_headers, body = self.respond(method, target, headers)
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = (version == 'HTTP/1.1' and connection != 'close') or connection == 'keep-alive'
+                    keep_alive = keep_alive and method in ('GET', 'HEAD')
+                    if method == 'HEAD':
+                        response_headers['Content-Length'] = str(len(body))
+                        body = b''
+
+                self.requests_served += 1
+                response_headers.setdefault('Content-Length', str(len(body)))
+                response_headers['Date'] = formatdate(usegmt=True)
+                response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                head = f"HTTP/1.1 {status} {REASONS[status]}\r\n" + ''.join(
+                    f"{name}: {value}\r\n" for name, value in response_headers.items()
+                ) + "\r\n"
+                writer.write(head.encode('latin-1') + body)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        await self.refresh()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        refresher = asyncio.create_task(self.refresh_periodically())
+        logger.info("Carte disponible sur http://%s:%d/", host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            refresher.cancel()
+
+def serve(load_dataframes, host='127.0.0.1', port=8000, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+          render_mode='split'):
+    """Démarre le serveur de la carte (mode 'split' ou 'clusters') jusqu'à son interruption (Ctrl+C)."""
+    server = MapServer(load_dataframes, refresh_interval, render_mode)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+async def _load_test_worker(host, port, path, count, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: gzip\r\n\r\n".encode('latin-1')
+    try:
+        for _ in range(count):
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+
+async def load_test(host='127.0.0.1', port=8000, path='/', concurrency=50, requests_per_client=100):
+    """Envoie des requêtes concurrentes (connexions keep-alive) et renvoie débit et latences."""
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _load_test_worker(host, port, path, requests_per_client, latencies) for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test de charge du serveur de la carte (voir carte_complete.py --serve).")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--path', default='/', help="ressource demandée")
+    parser.add_argument('--concurrency', type=int, default=50, help="nombre de connexions simultanées")
+    parser.add_argument('--requests', type=int, default=100, help="requêtes par connexion")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(load_test(args.host, args.port, args.path, args.concurrency, args.requests))
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
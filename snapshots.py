@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+from datetime import datetime, timezone
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow n'est nécessaire que pour les instantanés
+    pa = None
+    pq = None
+
+# Version du format des instantanés, incrémentée si la structure des tables change
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_DIR = 'snapshots'
+MANIFEST_NAME = 'manifest.json'
+
+# Extension des fichiers selon le format : 'arrow' (IPC, projetable en mémoire) ou 'parquet' (compact)
+FORMAT_EXTENSIONS = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Les instantanés nécessitent pyarrow : pip install pyarrow")
+
+def _read_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME), encoding='utf-8') as f:
+        return json.load(f)
+
+def list_snapshots(directory=SNAPSHOT_DIR):
+    """Liste les instantanés valides d'un répertoire, du plus ancien au plus récent."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.exists(os.path.join(directory, name, MANIFEST_NAME))
+    )
+
+def latest_snapshot(directory=SNAPSHOT_DIR):
+    snapshots = list_snapshots(directory)
+    return snapshots[-1] if snapshots else None
+
+def write_snapshot(dataframes, directory=SNAPSHOT_DIR, fmt='arrow', fingerprints=None, created_at=None):
+    """Enregistre les DataFrames normalisés dans un nouvel instantané daté.
+
+    Si des empreintes (voir empreintes.fingerprint_dataframe) sont fournies et identiques à celles
+    du dernier instantané, aucun nouvel instantané n'est écrit et le chemin du dernier est renvoyé.
+    """
+    _require_pyarrow()
+    created_at = created_at or datetime.now(timezone.utc)
+    digests = {dataset: fingerprint['digest'] for dataset, fingerprint in (fingerprints or {}).items()}
+
+    previous = latest_snapshot(directory)
+    if previous and digests:
+        previous_digests = {
+            dataset: info.get('digest') for dataset, info in _read_manifest(previous)['datasets'].items()
+        }
+        if previous_digests == digests:
+            return previous
+
+    path = os.path.join(directory, created_at.strftime('%Y-%m-%dT%H%M%SZ'))
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    datasets = {}
+    for dataset, df in dataframes.items():
+        file_name = dataset + FORMAT_EXTENSIONS[fmt]
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if fmt == 'arrow':
+            with pa.OSFile(os.path.join(tmp_path, file_name), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        else:
+            pq.write_table(table, os.path.join(tmp_path, file_name), compression='zstd')
+        datasets[dataset] = {'file': file_name, 'rows': len(df), 'digest': digests.get(dataset)}
+
+    manifest = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'format': fmt,
+        'created_at': created_at.isoformat(timespec='seconds'),
+        'datasets': datasets,
+    }
+    with open(os.path.join(tmp_path, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # Le renommage rend l'instantané visible d'un seul coup
+    os.replace(tmp_path, path)
+    return path
+
+def load_snapshot(path=None, directory=SNAPSHOT_DIR, datasets=None):
+    """Charge un instantané (le plus récent par défaut) en projetant ses fichiers en mémoire.
+
+    Renvoie un dictionnaire {jeu de données: DataFrame}, avec les mêmes types que les DataFrames
+    normalisés (catégories, float32, dates).
+    """
+    _require_pyarrow()
+    path = path or latest_snapshot(directory)
+    if path is None:
+        raise FileNotFoundError(f"Aucun instantané dans '{directory}'")
+
+    manifest = _read_manifest(path)
+    if manifest['format_version'] != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Version d'instantané non prise en charge: {manifest['format_version']}")
+
+    dataframes = {}
+    for dataset, info in manifest['datasets'].items():
+        if datasets is not None and dataset not in datasets:
+            continue
+        file_path = os.path.join(path, info['file'])
+        if manifest['format'] == 'arrow':
+            with pa.memory_map(file_path, 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+        else:
+            table = pq.read_table(file_path, memory_map=True)
+        dataframes[dataset] = table.to_pandas()
+    return dataframes
+
+def _commissioning_years(df):
+    if 'Année mise en service' in df:
+        return df['Année mise en service'].astype('Float64')
+    return df['Date mise en service'].dt.year.astype('Float64')
+
+def capacity_by_year(dataframes):
+    """Puissance installée (MW) mise en service chaque année, par jeu de données."""
+    columns = {}
+    for dataset, df in dataframes.items():
+        years = _commissioning_years(df)
+        columns[dataset] = df['Puissance (MW)'].astype('float64').groupby(years).sum()
+    result = pd.DataFrame(columns).fillna(0.0).round(3)
+    result.index = result.index.astype(int)
+    result.index.name = 'Année'
+    return result.sort_index()
+
+def capacity_history(directory=SNAPSHOT_DIR):
+    """Puissance installée totale (MW) par jeu de données dans chaque instantané."""
+    rows = {}
+    for path in list_snapshots(directory):
+        manifest = _read_manifest(path)
+        dataframes = load_snapshot(path)
+        rows[manifest['created_at']] = {
+            dataset: float(df['Puissance (MW)'].astype('float64').sum()) for dataset, df in dataframes.items()
+        }
+    history = pd.DataFrame.from_dict(rows, orient='index').round(3)
+    history.index.name = 'Instantané'
+    return history
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse des instantanés des centrales EDF.")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR, help="répertoire des instantanés")
+    parser.add_argument('--history', action='store_true',
+                        help="afficher la puissance installée totale de chaque instantané")
+    args = parser.parse_args(argv)
+
+    if args.history:
+        print(capacity_history(args.snapshot_dir).to_string())
+    else:
+        print(capacity_by_year(load_snapshot(directory=args.snapshot_dir)).to_string())
+
+if __name__ == "__main__":
+    main()
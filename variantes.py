@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from carte_complete import (DATASETS, POPUP_MODES, RENDER_MODES, _slugify, create_combined_map, get_layer_colors,
+                            map_data_dir, save_map)
+from instrumentation import stage
+from snapshots import load_snapshot, pa, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Clés reconnues dans la déclaration d'une variante
+VARIANT_KEYS = {'name', 'output', 'types', 'regions', 'departements', 'min_power', 'render', 'popups', 'hide'}
+
+# Colonne de catégorie (couleur de la couche) de chaque type de centrale, voir get_layer_colors
+COLOR_COLUMNS = {
+    'hydro': 'Catégorie',
+    'nuclear': 'Catégorie',
+    'flamme': 'Combustible',
+}
+
+# Régions (découpage de 2016) des départements, pour filtrer les jeux de données sans colonne Région
+REGION_DEPARTEMENTS = {
+    'AUVERGNE-RHONE-ALPES': ['AIN', 'ALLIER', 'ARDECHE', 'CANTAL', 'DROME', 'ISERE', 'LOIRE', 'HAUTE-LOIRE',
+                             'PUY-DE-DOME', 'RHONE', 'SAVOIE', 'HAUTE-SAVOIE'],
+    'BOURGOGNE-FRANCHE-COMTE': ["COTE-D'OR", 'DOUBS', 'JURA', 'NIEVRE', 'HAUTE-SAONE', 'SAONE-ET-LOIRE', 'YONNE',
+                                'TERRITOIRE DE BELFORT'],
+    'BRETAGNE': ["COTES-D'ARMOR", 'FINISTERE', 'ILLE-ET-VILAINE', 'MORBIHAN'],
+    'CENTRE-VAL DE LOIRE': ['CHER', 'EURE-ET-LOIR', 'INDRE', 'INDRE-ET-LOIRE', 'LOIR-ET-CHER', 'LOIRET'],
+    'CORSE': ['CORSE-DU-SUD', 'HAUTE-CORSE'],
+    'GRAND EST': ['ARDENNES', 'AUBE', 'MARNE', 'HAUTE-MARNE', 'MEURTHE-ET-MOSELLE', 'MEUSE', 'MOSELLE',
+                  'BAS-RHIN', 'HAUT-RHIN', 'VOSGES'],
+    'HAUTS-DE-FRANCE': ['AISNE', 'NORD', 'OISE', 'PAS-DE-CALAIS', 'SOMME'],
+    'ILE-DE-FRANCE': ['PARIS', 'SEINE-ET-MARNE', 'YVELINES', 'ESSONNE', 'HAUTS-DE-SEINE', 'SEINE-SAINT-DENIS',
+                      'VAL-DE-MARNE', "VAL-D'OISE"],
+    'NORMANDIE': ['CALVADOS', 'EURE', 'MANCHE', 'ORNE', 'SEINE-MARITIME'],
+    'NOUVELLE-AQUITAINE': ['CHARENTE', 'CHARENTE-MARITIME', 'CORREZE', 'CREUSE', 'DORDOGNE', 'GIRONDE', 'LANDES',
+                           'LOT-ET-GARONNE', 'PYRENEES-ATLANTIQUES', 'DEUX-SEVRES', 'VIENNE', 'HAUTE-VIENNE'],
+    'OCCITANIE': ['ARIEGE', 'AUDE', 'AVEYRON', 'GARD', 'HAUTE-GARONNE', 'GERS', 'HERAULT', 'LOT', 'LOZERE',
+                  'HAUTES-PYRENEES', 'PYRENEES-ORIENTALES', 'TARN', 'TARN-ET-GARONNE'],
+    'PAYS DE LA LOIRE': ['LOIRE-ATLANTIQUE', 'MAINE-ET-LOIRE', 'MAYENNE', 'SARTHE', 'VENDEE'],
+    "PROVENCE-ALPES-COTE D'AZUR": ['ALPES-DE-HAUTE-PROVENCE', 'HAUTES-ALPES', 'ALPES-MARITIMES',
+                                   'BOUCHES-DU-RHONE', 'VAR', 'VAUCLUSE'],
+    'GUADELOUPE': ['GUADELOUPE'],
+    'MARTINIQUE': ['MARTINIQUE'],
+    'GUYANE': ['GUYANE'],
+    'LA REUNION': ['LA REUNION'],
+    'MAYOTTE': ['MAYOTTE'],
+}
+
+# Les noms sont comparés sous forme normalisée (sans accents ni ponctuation)
+REGION_BY_DEPARTEMENT = {
+    _slugify(departement): _slugify(region)
+    for region, departements in REGION_DEPARTEMENTS.items() for departement in departements
+}
+
+def _check_variant(variant):
+    """Vérifie les valeurs d'une variante ; lève ValueError en nommant la variante."""
+    name = variant['name']
+    for key in ('types', 'hide', 'regions', 'departements'):
+        values = variant.get(key, [])
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise ValueError(f"variante {name!r}: '{key}' doit être une liste de noms")
+    for key in ('types', 'hide'):
+        unknown = set(variant.get(key, [])) - set(DATASETS)
+        if unknown:
+            raise ValueError(f"variante {name!r}: type(s) de centrale inconnu(s) dans '{key}': "
+                             f"{', '.join(sorted(unknown))} ({', '.join(DATASETS)})")
+    if variant.get('render', 'fast') not in RENDER_MODES:
+        raise ValueError(f"variante {name!r}: mode de rendu inconnu {variant['render']!r} ({', '.join(RENDER_MODES)})")
+    if variant.get('popups', 'deferred') not in POPUP_MODES:
+        raise ValueError(f"variante {name!r}: mode de popups inconnu {variant['popups']!r} ({', '.join(POPUP_MODES)})")
+    min_power = variant.get('min_power')
+    if min_power is not None and (isinstance(min_power, bool) or not isinstance(min_power, (int, float))):
+        raise ValueError(f"variante {name!r}: 'min_power' doit être un nombre (MW), pas {min_power!r}")
+    if variant.get('output') is not None and not isinstance(variant['output'], str):
+        raise ValueError(f"variante {name!r}: 'output' doit être un chemin de fichier")
+
+def load_variants(path):
+    """Charge la liste des variantes déclarées dans un fichier JSON et vérifie leurs clés et leurs valeurs."""
+    with open(path, encoding='utf-8') as f:
+        variants = json.load(f)
+    if not isinstance(variants, list):
+        raise ValueError("le fichier de variantes doit contenir une liste")
+
+    names = set()
+    for variant in variants:
+        if not isinstance(variant, dict):
+            raise ValueError(f"chaque variante doit être un objet JSON, pas {variant!r}")
+        unknown = set(variant) - VARIANT_KEYS
+        if unknown:
+            raise ValueError(f"clé(s) inconnue(s) dans la variante {variant.get('name')!r}: {', '.join(sorted(unknown))}")
+        if 'name' not in variant:
+            raise ValueError("chaque variante doit avoir un nom ('name')")
+        if variant['name'] in names:
+            raise ValueError(f"variante déclarée deux fois: {variant['name']!r}")
+        _check_variant(variant)
+        names.add(variant['name'])
+    return variants
+
+def _slugs(series):
+    return series.astype(object).map(_slugify, na_action='ignore')
+
+def filter_dataframe(df, dataset, variant):
+    """Sélectionne les centrales d'un jeu de données correspondant aux filtres d'une variante."""
+    if dataset not in variant.get('types', DATASETS):
+        return df.iloc[:0]
+
+    mask = pd.Series(True, index=df.index)
+    if variant.get('min_power') is not None:
+        mask &= df['Puissance (MW)'] >= variant['min_power']
+
+    if variant.get('regions'):
+        regions = {_slugify(region) for region in variant['regions']}
+        in_region = pd.Series(False, index=df.index)
+        if 'Région' in df:
+            in_region |= _slugs(df['Région']).isin(regions)
+        if 'Département' in df:
+            in_region |= _slugs(df['Département']).map(REGION_BY_DEPARTEMENT).isin(regions)
+        mask &= in_region
+
+    if variant.get('departements'):
+        if 'Département' not in df:
+            return df.iloc[:0]
+        mask &= _slugs(df['Département']).isin({_slugify(departement) for departement in variant['departements']})
+
+    return df[mask.fillna(False).astype(bool)]
+
+def variant_colors(colors, dataframes):
+    """Restreint les couleurs communes aux catégories présentes dans une variante (même attribution)."""
+    return tuple(
+        {category: color for category, color in dataset_colors.items()
+         if category in set(dataframes[dataset][COLOR_COLUMNS[dataset]].dropna().unique())}
+        for dataset, dataset_colors in zip(('hydro', 'nuclear', 'flamme'), colors)
+    )
+
+def variant_output(variant, output_dir):
+    """Chemin de la carte d'une variante ('output' relatif à output_dir, ou carte_<nom>.html)."""
+    return os.path.join(output_dir, variant.get('output') or f"carte_{_slugify(variant['name'])}.html")
+
+# DataFrames et couleurs communes de chaque processus de rendu (voir _init_worker)
+_worker_dataframes = None
+_worker_colors = None
+
+def _init_worker(snapshot_path, dataframes, colors):
+    """Charge une fois par processus les DataFrames, depuis l'instantané Arrow projeté en mémoire si possible."""
+    global _worker_dataframes, _worker_colors
+    _worker_dataframes = load_snapshot(snapshot_path) if snapshot_path else dataframes
+    _worker_colors = colors
+
+def render_variant(variant, output_dir, dataframes=None, colors=None):
+    """Filtre les données, construit et enregistre la carte d'une variante ; renvoie son résumé."""
+    dataframes = dataframes if dataframes is not None else _worker_dataframes
+    colors = colors if colors is not None else _worker_colors
+    started = time.perf_counter()
+
+    filtered = {dataset: filter_dataframe(df, dataset, variant) for dataset, df in dataframes.items()}
+    output = variant_output(variant, output_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    m = create_combined_map(
+        filtered['hydro'], filtered['nuclear'], filtered['flamme'],
+        render_mode=variant.get('render', 'fast'),
+        data_dir=map_data_dir(output),
+        hidden_types=variant.get('hide', ()),
+        popups=variant.get('popups', 'deferred'),
+        colors=variant_colors(colors, filtered),
+    )
+    save_map(m, output)
+    return {
+        'name': variant['name'],
+        'output': output,
+        'rows': {dataset: len(df) for dataset, df in filtered.items()},
+        'seconds': round(time.perf_counter() - started, 3),
+        'pid': os.getpid(),
+    }
+
+def render_variants(dataframes, variants, output_dir='.', jobs=None):
+    """Construit les cartes de plusieurs variantes en parallèle à partir d'un seul chargement des données.
+
+    Les DataFrames sont enregistrés une fois dans un instantané Arrow temporaire que chaque processus
+    projette en mémoire (sans pyarrow, ils sont transmis à chaque processus). Les couleurs sont
+    attribuées une seule fois sur l'ensemble des données : toutes les cartes partagent la même légende.
+    """
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(variants)))
+    colors = get_layer_colors(dataframes['hydro'], dataframes['nuclear'], dataframes['flamme'])
+    shared_dir = tempfile.mkdtemp(prefix='variantes_')
+    try:
+        snapshot_path = None
+        if pa is not None:
+            with stage('share_dataframes'):
+                snapshot_path = write_snapshot(dataframes, shared_dir, fmt='arrow')
+
+        results = []
+        with stage('render_variants', variants=len(variants), jobs=jobs):
+            with ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker,
+                initargs=(snapshot_path, None if snapshot_path else dataframes, colors)
+            ) as executor:
+                futures = {executor.submit(render_variant, variant, output_dir): variant for variant in variants}
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    logger.info("Variante '%s' : %s (%d centrales, %.2f s)", result['name'], result['output'],
+                                sum(result['rows'].values()), result['seconds'], extra={'fields': result})
+        order = {variant['name']: position for position, variant in enumerate(variants)}
+        return sorted(results, key=lambda result: order[result['name']])
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)